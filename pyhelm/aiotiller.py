@@ -0,0 +1,452 @@
+# -*- coding:utf-8 -*-
+import asyncio
+import logging
+import os
+import sys
+import time
+
+import yaml
+
+from grpc import aio
+from hapi.chart.config_pb2 import Config
+from hapi.services.tiller_pb2 import (GetHistoryRequest,
+                                      GetReleaseContentRequest,
+                                      GetReleaseStatusRequest,
+                                      GetVersionRequest, InstallReleaseRequest,
+                                      RollbackReleaseRequest,
+                                      TestReleaseRequest,
+                                      UninstallReleaseRequest,
+                                      UpdateReleaseRequest)
+
+""" AsyncTiller class 基于grpc.aio的异步tiller控制函数"""
+
+sys.path.insert(0, os.path.split(
+    os.path.abspath(os.path.dirname(__file__)))[0])
+
+from metrics import aio_interceptors
+from tiller import (Tiller, CleanupPlan, CleanupResult, CLEANUP_WORKERS,
+                    LIST_PAGE_SIZE, MAX_HISTORY, RELEASE_LIMIT,
+                    REQUEST_TIMEOUT, STATUS_CONCURRENCY, _field_tree,
+                    _project)
+
+LOG = logging.getLogger('pyhelm')
+
+__all__ = ["AsyncTiller", "get_interceptors", "get_channel", "close", "read", "get_release_content",
+           "get_release_status", "get_release_statuses", "list_releases", "iter_releases",
+           "list_charts", "update_release", "install_release",
+           "rollback_release", "get_history", "test_release",
+           "uninstall_release", "get_version", "plan_cleanup",
+           "execute_cleanup", "chart_cleanup"]
+
+
+class AsyncTiller(Tiller):
+    '''
+    AsyncTiller class 通过grpc.aio协议与tiller进行交流.
+
+    与Tiller的方法一一对应,所有rpc方法均为协程,需要在同一个event loop中使用:
+
+        tiller = AsyncTiller(host)
+        status = await tiller.get_release_status('mongodb')
+        async for release in tiller.iter_releases():
+            ...
+        await tiller.close()
+    '''
+
+    def __init__(self, *args, **kwargs):
+        """参数同Tiller.__init__"""
+        super(AsyncTiller, self).__init__(*args, **kwargs)
+        # single_flight开启时,进行中的读请求{(方法名, 请求): Task}
+        self._inflight = {}
+
+    def get_interceptors(self):
+        '''
+        Args:
+            无参数
+        Return:
+            Return grpc.aio client interceptors,interceptors参数中需为grpc.aio的拦截器
+        '''
+        interceptors = list(self.interceptors)
+        if self.metrics is not None:
+            interceptors[:0] = aio_interceptors(self.metrics)
+        return interceptors
+
+    def get_channel(self):
+        '''
+        Args:
+            无参数
+        Return:
+            Return a grpc.aio tiller channel
+        '''
+        if self.ssl_verification:
+            return aio.secure_channel(self._host + ":" + self._port,
+                                      self.get_credentials(),
+                                      options=self.get_channel_options(),
+                                      interceptors=self.get_interceptors() or None)
+        else:
+            return aio.insecure_channel('%s:%s' % (self._host, self._port),
+                                        options=self.get_channel_options(),
+                                        interceptors=self.get_interceptors() or None)
+
+    async def close(self):
+        '''关闭连接池中的所有channel,取消所有未完成的rpc'''
+        await asyncio.gather(*[channel.close() for channel in self.channels])
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def _call(self, method, request, **kwargs):
+        """按照self.policy发送unary请求,参数同Tiller._call"""
+        deadline = self.policy.begin(method, self.timeout)
+        attempt = 0
+        while True:
+            try:
+                return await getattr(self.stub, method)(
+                    request, timeout=max(deadline - time.monotonic(), 0),
+                    metadata=self.metadata, **kwargs)
+            except aio.AioRpcError as e:
+                delay = self.policy.retry_delay(method, e, attempt, deadline)
+                if delay is None:
+                    raise
+                LOG.debug("%s failed: %s, retry in %.3fs", method, e.code(), delay)
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    def _stream(self, method, request):
+        """按照self.policy发送response-streaming请求,参数同Tiller._stream"""
+        if method not in self.policy.idempotent_methods:
+            deadline = self.policy.begin(method, self.timeout)
+            return getattr(self.stub, method)(
+                request, timeout=max(deadline - time.monotonic(), 0),
+                metadata=self.metadata)
+        return self._retry_stream(method, request)
+
+    async def _retry_stream(self, method, request):
+        deadline = self.policy.begin(method, self.timeout)
+        attempt = 0
+        received = 0
+        while True:
+            skip = received
+            try:
+                async for response in getattr(self.stub, method)(
+                        request, timeout=max(deadline - time.monotonic(), 0),
+                        metadata=self.metadata):
+                    if skip:
+                        skip -= 1
+                        continue
+                    received += 1
+                    yield response
+                return
+            except aio.AioRpcError as e:
+                delay = self.policy.retry_delay(method, e, attempt, deadline)
+                if delay is None:
+                    raise
+                LOG.debug("%s failed: %s, retry in %.3fs", method, e.code(), delay)
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    async def read(self, method, request):
+        """发送只读的unary请求,参数同Tiller.read
+
+        开启single_flight时相同的请求共享同一个Task,
+        单个调用方被取消不会取消其他调用方正在等待的请求
+        """
+        if self.single_flight is None:
+            return await self._call(method, request)
+        key = (method, request.SerializeToString(deterministic=True))
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._call(method, request))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def get_release_content(self, name, version=0):
+        """获得具体release的内容,参数同Tiller.get_release_content
+        Returns:
+            Release content
+        """
+        if self.cache is not None:
+            release_content = self.cache.get_content(name, version)
+            if release_content is not None:
+                return release_content
+        req = GetReleaseContentRequest(name=name, version=version)
+        release_content = await self.read('GetReleaseContent', req)
+        if self.cache is not None:
+            self.cache.put_content(name, version, release_content)
+        return release_content
+
+    async def get_release_status(self, name):
+        """获得具体release的状态
+        Args:
+            name: release名称
+        Returns:
+            Release状态
+        """
+        req = GetReleaseStatusRequest(name=name)
+        return await self.read('GetReleaseStatus', req)
+
+    async def get_release_statuses(self, names,
+                                   max_concurrency=STATUS_CONCURRENCY):
+        """批量获得release的状态,参数同Tiller.get_release_statuses
+        Returns:
+            {release名称: Release状态}字典,请求失败的release对应的值为异常对象
+        """
+        semaphore = asyncio.Semaphore(max(int(max_concurrency), 1))
+
+        async def fetch(name):
+            async with semaphore:
+                try:
+                    return await self.get_release_status(name)
+                except aio.AioRpcError as e:
+                    LOG.debug("Get status of release %s failed: %s", name, e)
+                    return e
+
+        names = list(dict.fromkeys(names))
+        statuses = await asyncio.gather(*[fetch(name) for name in names])
+        return dict(zip(names, statuses))
+
+    async def iter_releases(self, page_size=LIST_PAGE_SIZE, status_codes=[],
+                            namespace=None, sort_by='NAME', sort_order='ASC',
+                            filter='', fields=None):
+        '''分页异步迭代release,参数同Tiller.iter_releases
+        Returns:
+            async iterator of Helm Releases
+        '''
+        tree = _field_tree(fields) if fields is not None else None
+        offset = ''
+        while True:
+            req = self.list_releases_request(
+                limit=page_size, offset=offset, status_codes=status_codes,
+                namespace=namespace, sort_by=sort_by, sort_order=sort_order,
+                filter=filter)
+            offset = ''
+            async for y in self._stream('ListReleases', req):
+                offset = y.next or offset
+                for release in y.releases:
+                    yield release if tree is None else _project(release, tree)
+            if not offset:
+                break
+
+    async def list_releases(self, limit=RELEASE_LIMIT, status_codes=[],
+                            namespace=None, fields=None):
+        '''获得release列表
+        Args:
+            :params limit - number of result
+            :params status_codes - status_codes list used for filter
+            :params namespace(srt) - k8s namespace
+            :params fields - 只保留的release字段,为None时返回完整的release
+        Returns:
+            List Helm Releases
+        '''
+        releases = []
+        req = self.list_releases_request(
+            limit=limit, status_codes=status_codes, namespace=namespace)
+        async for y in self._stream('ListReleases', req):
+            if fields is None:
+                releases.extend(y.releases)
+            else:
+                releases.extend(self.project_release(release, fields)
+                                for release in y.releases)
+        return releases
+
+    async def list_charts(self, fields=None):
+        '''
+        List Helm Charts from Latest Releases
+        Args:
+            fields: 只保留的release字段,未包含的chart/values将为空
+        Return:
+            list of (name, version, chart, values)
+        '''
+        charts = []
+        async for latest_release in self.iter_releases(fields=fields):
+            charts.append((latest_release.name, latest_release.version,
+                           latest_release.chart,
+                           latest_release.config.raw))
+        return charts
+
+    async def update_release(self, chart, name, dry_run=False,
+                             disable_hooks=False, values=None, recreate=False,
+                             reset_values=False, reuse_values=False,
+                             force=False, timeout=REQUEST_TIMEOUT,
+                             compression=None):
+        """升级release,参数同Tiller.update_release
+        Returns:
+            返回升级release的grpc响应对象
+        """
+        values = Config(raw=yaml.safe_dump(values or {}))
+
+        release_request = UpdateReleaseRequest(
+            chart=chart,
+            dry_run=dry_run,
+            recreate=recreate,
+            reset_values=reset_values,
+            reuse_values=reuse_values,
+            force=force,
+            disable_hooks=disable_hooks,
+            values=values,
+            timeout=timeout,
+            name=name)
+        self.check_request_size(release_request)
+        try:
+            return await self._call(
+                'UpdateRelease', release_request,
+                compression=self.compression if compression is None
+                else self.get_compression(compression))
+        finally:
+            if not dry_run:
+                self.invalidate_cache(name)
+
+    async def install_release(self, chart, namespace, disable_hooks=False,
+                              reuse_name=False, disable_crd_hook=False,
+                              timeout=REQUEST_TIMEOUT, dry_run=False,
+                              name=None, values=None, compression=None):
+        """安装release,参数同Tiller.install_release
+        Returns:
+            返回安装release的grpc响应对象
+        """
+        release_request = InstallReleaseRequest(
+            chart=chart,
+            disable_hooks=disable_hooks,
+            reuse_name=reuse_name,
+            disable_crd_hook=disable_crd_hook,
+            dry_run=dry_run,
+            timeout=timeout,
+            values=values,
+            name=name or '',
+            namespace=namespace)
+        self.check_request_size(release_request)
+        try:
+            return await self._call(
+                'InstallRelease', release_request,
+                compression=self.compression if compression is None
+                else self.get_compression(compression))
+        finally:
+            if name and not dry_run:
+                self.invalidate_cache(name)
+
+    async def rollback_release(self, name, version, timeout=REQUEST_TIMEOUT,
+                               dry_run=False, disable_hooks=False,
+                               recreate=False, wait=False, force=False):
+        """回滚release,参数同Tiller.rollback_release
+        Returns:
+            返回回滚release的grpc响应对象
+        """
+        rollback_release_request = RollbackReleaseRequest(
+            name=name,
+            timeout=timeout,
+            version=version,
+            dry_run=dry_run,
+            disable_hooks=disable_hooks,
+            recreate=recreate,
+            wait=wait,
+            force=force)
+        try:
+            return await self._call('RollbackRelease',
+                                    rollback_release_request)
+        finally:
+            if not dry_run:
+                self.invalidate_cache(name)
+
+    async def get_history(self, name, max=MAX_HISTORY):
+        """usage: ReleaseHistory retrieves a releasse's history
+        Args:
+            :params - name(string) - release name
+            :params - max(int) - max items of release history
+        Return:
+            返回版本的历史的grpc响应对象
+        """
+        if self.cache is not None:
+            history = self.cache.get_history(name, max)
+            if history is not None:
+                return history
+        get_history_request = GetHistoryRequest(name=name,
+                                                max=max)
+        history = await self.read('GetHistory', get_history_request)
+        if self.cache is not None:
+            self.cache.put_history(name, max, history)
+        return history
+
+    def test_release(self, name, cleanup=False, timeout=REQUEST_TIMEOUT):
+        """usage: RunReleaseTest executes the tests defined of a named release
+
+        注意:该方法不是协程,返回的流对象需使用async for迭代:
+            async for resp in tiller.test_release(name):
+                print(resp.msg)
+        Args:
+            :params - name(string) - release name
+            :params - cleanup(bool) - delete test pods upon completion
+        Returns:
+            返回测试结果的异步流对象
+        """
+        test_release_request = TestReleaseRequest(name=name,
+                                                  cleanup=cleanup)
+        return self._stream('RunReleaseTest', test_release_request)
+
+    async def uninstall_release(self, release, timeout=REQUEST_TIMEOUT,
+                                disable_hooks=False, purge=False):
+        """deletes a helm chart from tiller
+        Args:
+            :params - release - helm chart release name
+            :params - purge - deep delete of chart
+        Returns:
+            返回卸载release的grpc响应对象
+        """
+        release_request = UninstallReleaseRequest(name=release,
+                                                  timeout=timeout,
+                                                  disable_hooks=disable_hooks,
+                                                  purge=purge)
+        try:
+            return await self._call('UninstallRelease', release_request)
+        finally:
+            self.invalidate_cache(release)
+
+    async def get_version(self):
+        """GetVersion returns the current version of the server
+        Returns:
+            返回tiller的版本grpc响应对象
+        """
+        get_version_request = GetVersionRequest()
+        return await self.read('GetVersion', get_version_request)
+
+    async def plan_cleanup(self, prefix, charts):
+        """计算chart_cleanup需要删除的release,参数同Tiller.plan_cleanup"""
+        actual_charts = [x.name async for x in self.iter_releases(fields=("name",))]
+        return CleanupPlan.build(prefix, charts, actual_charts)
+
+    async def execute_cleanup(self, plan, workers=CLEANUP_WORKERS, **kwargs):
+        """并发卸载plan中的release,参数同Tiller.execute_cleanup"""
+        semaphore = asyncio.Semaphore(max(int(workers), 1))
+
+        async def uninstall(chart):
+            async with semaphore:
+                LOG.debug("Release: %s will be removed", chart)
+                start = time.time()
+                try:
+                    response = await self.uninstall_release(chart, **kwargs)
+                except Exception as e:
+                    LOG.error("Remove release %s failed: %s", chart, e)
+                    return CleanupResult(chart, None, e, time.time() - start)
+                return CleanupResult(chart, response, None, time.time() - start)
+
+        results = await asyncio.gather(*[uninstall(chart) for chart in plan.releases])
+        plan.results.update((result.name, result) for result in results)
+        return plan
+
+    async def chart_cleanup(self, prefix, charts, dry_run=False,
+                            workers=CLEANUP_WORKERS, **kwargs):
+        """参数同Tiller.chart_cleanup
+
+        :result - 返回CleanupPlan对象
+        """
+        plan = await self.plan_cleanup(prefix, charts)
+        if dry_run:
+            return plan
+        return await self.execute_cleanup(plan, workers=workers, **kwargs)
+
+
+if __name__ == "__main__":
+    import aiotiller
+    print(help(aiotiller))
@@ -0,0 +1,464 @@
+#-*- coding:utf-8 -*-
+"""
+cache 包含chart压缩包的本地磁盘缓存,repo index.yaml的缓存,
+chart构建结果的缓存以及tiller release读请求的缓存
+"""
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+from hapi.release.status_pb2 import Status
+
+LOG = logging.getLogger('pyhelm')
+# 默认缓存上限1G
+CHART_CACHE_SIZE = 1024 * 1024 * 1024
+# index.yaml在进程内的有效时间(秒),过期后使用条件请求重新验证
+INDEX_TTL = 60
+# 进程内缓存的chart构建结果数量
+BUILD_CACHE_ENTRIES = 128
+# 进程内chart构建缓存上限64M
+BUILD_CACHE_SIZE = 64 * 1024 * 1024
+# release内容缓存上限64M
+RELEASE_CACHE_SIZE = 64 * 1024 * 1024
+# 最新版本号,release历史以及非SUPERSEDED状态的release内容的有效时间(秒)
+RELEASE_CACHE_TTL = 5
+
+__all__ = ["ChartCache", "IndexCache", "ChartBuildCache", "ReleaseCache", "DigestReader", "key", "path", "get",
+           "put", "evict", "clear", "fetch", "invalidate", "get_content", "put_content", "get_history",
+           "put_history"]
+
+
+class DigestReader(object):
+    """File object wrapper computing sha256 of the data read through it
+
+    用于边下载边校验chart压缩包的digest
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.sha256.update(data)
+        return data
+
+    def drain(self, chunk_size=64 * 1024):
+        """read the rest of the stream so that the digest covers all data"""
+        while self.read(chunk_size):
+            pass
+
+    def hexdigest(self):
+        return self.sha256.hexdigest()
+
+    def verify(self, digest):
+        """return True if digest is empty or matches the data read"""
+        return not digest or self.hexdigest() == digest
+
+
+class ChartCache(object):
+    """Content addressed cache for chart archives
+
+    以index.yaml中的digest(没有digest时使用url+version的sha256)为key,
+    将chart的.tgz文件保存在directory目录下,总大小超过max_size时按照
+    最近使用时间(LRU)淘汰.
+    """
+
+    def __init__(self, directory, max_size=CHART_CACHE_SIZE):
+        """
+        Args:
+            directory: 缓存目录(str),不存在时自动创建
+            max_size: 缓存总大小上限,单位字节(int)
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    @staticmethod
+    def key(url, version=None, digest=None):
+        """return cache key of the chart archive
+
+        Args:
+            url: chart下载链接(str)
+            version: chart版本(str)
+            digest: index.yaml中chart的sha256 digest(str)
+
+        Returns:
+            缓存key(str)
+        """
+        if digest:
+            return digest
+        return hashlib.sha256(
+            "{}@{}".format(url, version or "").encode("utf-8")).hexdigest()
+
+    def path(self, key):
+        """return archive path of the key"""
+        return os.path.join(self.directory, key + ".tgz")
+
+    def get(self, key):
+        """return cached archive path or None
+
+        命中时更新文件的mtime,作为LRU淘汰依据
+        Args:
+            key: 缓存key(str)
+
+        Returns:
+            .tgz文件路径,未命中时返回None
+        """
+        path = self.path(key)
+        try:
+            os.utime(path, None)
+        except OSError:
+            return None
+        return path
+
+    def put(self, key, fileobj, digest=None):
+        """save archive into cache
+
+        先写入临时文件再rename,保证并发时不会读到写了一半的文件
+        Args:
+            key: 缓存key(str)
+            fileobj: chart压缩包的文件对象
+            digest: 期望的sha256,不一致时抛出ValueError且不写入缓存
+
+        Returns:
+            .tgz文件路径
+        """
+        path = self.path(key)
+        reader = DigestReader(fileobj)
+        fd, tmp_path = tempfile.mkstemp(prefix=".pyhelm-", dir=self.directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                shutil.copyfileobj(reader, f)
+            if not reader.verify(digest):
+                raise ValueError("Digest mismatch for {}: expected {}, got {}".format(
+                    key, digest, reader.hexdigest()))
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.evict()
+        return path
+
+    def evict(self):
+        """remove least recently used archives until size <= max_size"""
+        with self._lock:
+            entries = []
+            total = 0
+            for entry in os.scandir(self.directory):
+                if not entry.name.endswith(".tgz"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+            if total <= self.max_size:
+                return
+            for _, size, path in sorted(entries):
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                LOG.debug("Chart cache evict %s", path)
+                total -= size
+                if total <= self.max_size:
+                    break
+
+    def clear(self):
+        """remove all cached archives"""
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".tgz"):
+                os.remove(entry.path)
+
+
+class IndexCache(object):
+    """In-process cache for repo index.yaml
+
+    ttl时间内直接返回已解析的index;过期后携带ETag/Last-Modified
+    发送条件请求,服务端返回304时只刷新时间而不重新下载和解析.
+    同一个url的并发请求只会发送一次.
+    """
+
+    def __init__(self, ttl=INDEX_TTL):
+        """
+        Args:
+            ttl: index在进程内的有效时间,单位秒(int)
+        """
+        self.ttl = ttl
+        self._entries = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def _url_lock(self, url):
+        with self._lock:
+            return self._locks.setdefault(url, threading.Lock())
+
+    def fetch(self, url, parser, timeout=3):
+        """return parsed index of url
+
+        Args:
+            url: index.yaml链接(str)
+            parser: 解析函数,参数为响应的bytes
+            timeout: 请求超时时间
+
+        Returns:
+            parser的返回值
+        """
+        with self._url_lock(url):
+            entry = self._entries.get(url)
+            if entry is not None and time.time() - entry['checked'] < self.ttl:
+                return entry['data']
+
+            headers = {}
+            if entry is not None:
+                if entry['etag']:
+                    headers['If-None-Match'] = entry['etag']
+                if entry['last_modified']:
+                    headers['If-Modified-Since'] = entry['last_modified']
+            resp = requests.get(url, headers=headers, timeout=timeout)
+            if entry is not None and resp.status_code == 304:
+                LOG.debug("Index %s not modified", url)
+                entry['checked'] = time.time()
+                return entry['data']
+            resp.raise_for_status()
+
+            data = parser(resp.content)
+            self._entries[url] = {
+                'etag': resp.headers.get('ETag'),
+                'last_modified': resp.headers.get('Last-Modified'),
+                'data': data,
+                'checked': time.time(),
+            }
+            return data
+
+    def invalidate(self, url=None):
+        """drop cached index of url, or all indexes when url is None"""
+        with self._lock:
+            if url is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(url, None)
+
+
+class ChartBuildCache(object):
+    """Cache for serialized hapi.chart.Chart
+
+    以chart源文件内容的hash为key,缓存序列化后的Chart数据.
+    进程内使用LRU保存最多max_entries个,总大小不超过max_size,
+    指定directory时同时保存到磁盘.
+    """
+
+    def __init__(self, max_entries=BUILD_CACHE_ENTRIES, directory=None,
+                 max_size=BUILD_CACHE_SIZE):
+        """
+        Args:
+            max_entries: 进程内缓存数量(int)
+            directory: 磁盘缓存目录(str),为None时只使用进程内缓存
+            max_size: 进程内缓存总大小上限,单位字节(int)
+        """
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.size = 0
+        self.directory = directory
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".chart")
+
+    def get(self, key):
+        """return serialized chart bytes or None"""
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                return data
+        if self.directory is None:
+            return None
+        try:
+            with open(self._path(key), "rb") as f:
+                data = f.read()
+        except (IOError, OSError):
+            return None
+        self._remember(key, data)
+        return data
+
+    def put(self, key, data):
+        """save serialized chart bytes"""
+        self._remember(key, data)
+        if self.directory is None:
+            return
+        fd, tmp_path = tempfile.mkstemp(prefix=".pyhelm-", dir=self.directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, self._path(key))
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _remember(self, key, data):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            if len(data) > self.max_size:
+                return
+            self._entries[key] = data
+            self.size += len(data)
+            while len(self._entries) > self.max_entries or self.size > self.max_size:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self):
+        """remove all cached charts"""
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+        if self.directory is not None:
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(".chart"):
+                    os.remove(entry.path)
+
+
+class ReleaseCache(object):
+    """Read-through cache for tiller GetReleaseContent/GetHistory responses
+
+    (release名称, revision)的chart和manifest写入后不会再变化,但其中的状态会变化
+    (PENDING_*变为DEPLOYED/FAILED,其他客户端升级后DEPLOYED/FAILED变为SUPERSEDED),
+    因此只有SUPERSEDED状态的release内容一直缓存,其他状态的内容和release历史
+    只缓存ttl秒.两者按序列化后的大小共用一个LRU,总大小保存在max_size以内.
+    请求最新版本(version=0)时只在ttl内复用最新的revision号,过期的条目在访问
+    或写入时删除.
+    通过同一个Tiller执行update/rollback/uninstall时会调用invalidate.
+    返回的是缓存中的响应对象本身,调用方不应修改.
+    """
+
+    def __init__(self, max_size=RELEASE_CACHE_SIZE, ttl=RELEASE_CACHE_TTL):
+        """
+        Args:
+            max_size: release内容和历史缓存总大小上限,单位字节(int)
+            ttl: 最新版本号,release历史和非SUPERSEDED状态内容的有效时间,单位秒(int)
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.size = 0
+        # {('content', 名称, revision) / ('history', 名称, max): (响应, 大小, 写入时间)}
+        self._entries = OrderedDict()
+        # {名称: (revision, 写入时间)},按写入时间排序
+        self._latest = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key, ttl=None):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if ttl is not None and time.time() - entry[2] >= ttl:
+            self.size -= self._entries.pop(key)[1]
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def _put(self, key, response):
+        size = response.ByteSize()
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.size -= old[1]
+        if size > self.max_size:
+            return
+        self._entries[key] = (response, size, time.time())
+        self.size += size
+        while self.size > self.max_size:
+            _, (_, evicted, _) = self._entries.popitem(last=False)
+            self.size -= evicted
+
+    def _expire_latest(self, now):
+        while self._latest:
+            name, (_, stored) = next(iter(self._latest.items()))
+            if now - stored < self.ttl:
+                break
+            del self._latest[name]
+
+    def get_content(self, name, version=0):
+        """return cached GetReleaseContentResponse or None
+
+        Args:
+            name: release名称(str)
+            version: release revision(int),0表示最新版本
+        """
+        with self._lock:
+            if not version:
+                self._expire_latest(time.time())
+                latest = self._latest.get(name)
+                if latest is None:
+                    return None
+                version = latest[0]
+            key = ('content', name, version)
+            entry = self._entries.get(key)
+            if entry is not None and \
+                    entry[0].release.info.status.code == Status.SUPERSEDED:
+                return self._get(key)
+            return self._get(key, self.ttl)
+
+    def put_content(self, name, version, response):
+        """save GetReleaseContentResponse
+
+        Args:
+            name: release名称(str)
+            version: 请求的revision(int),0表示请求的是最新版本
+            response: GetReleaseContentResponse
+        """
+        revision = response.release.version
+        if not revision:
+            return
+        with self._lock:
+            if not version:
+                now = time.time()
+                self._latest.pop(name, None)
+                self._latest[name] = (revision, now)
+                self._expire_latest(now)
+            self._put(('content', name, revision), response)
+
+    def get_history(self, name, max):
+        """return cached GetHistoryResponse or None"""
+        with self._lock:
+            return self._get(('history', name, max), self.ttl)
+
+    def put_history(self, name, max, response):
+        """save GetHistoryResponse of (name, max)"""
+        with self._lock:
+            self._put(('history', name, max), response)
+
+    def invalidate(self, name=None):
+        """drop everything cached for release name, or all releases when name is None
+
+        uninstall --purge之后同名release的revision会重新从1开始,
+        因此同时删除该release所有revision的内容
+        """
+        with self._lock:
+            if name is None:
+                self._entries.clear()
+                self._latest.clear()
+                self.size = 0
+                return
+            self._latest.pop(name, None)
+            for key in [key for key in self._entries if key[1] == name]:
+                self.size -= self._entries.pop(key)[1]
+
+    def clear(self):
+        """remove all cached responses"""
+        self.invalidate()
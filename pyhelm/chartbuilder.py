@@ -1,9 +1,14 @@
 # -*- coding:utf-8 -*-
 """class ChartBuilder 主要功能是生成tiller所需的chart元数据"""
 
+import hashlib
+import io
 import logging
 import os
 import sys
+import tarfile
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 sys.path.insert(0, os.path.split(os.path.abspath(os.path.dirname(__file__)))[0])
 
 import yaml
@@ -16,16 +21,187 @@ from hapi.chart.template_pb2 import Template
 from google.protobuf.any_pb2 import Any
 
 from utils.exceptions import CustomError
+from utils import helmignore
+from utils.semver import VersionIndex, parse_version
+from cache import ChartBuildCache
 from repo import RepoUtils
+from values import ValuesTrie, compile_set
 
 LOG = logging.getLogger('pyhelm')
-
-__all__ = ["ChartBuilder", "coalesceTables", "pathtomap", "generate_values",
-           "source_clone", "source_cleanup", "get_metadata", "get_files",
-           "get_values", "get_templates", "get_dependencies", "get_helm_chart",
+# 并发获取dependencies的线程数
+DEPENDENCY_WORKERS = 8
+_DEPENDENCY_LOCK = threading.Lock()
+
+__all__ = ["ChartBuilder", "ChartSource", "coalesceTables", "pathtomap", "generate_values",
+           "source_clone", "source_cleanup", "load_source", "get_metadata", "get_files",
+           "get_values", "get_templates", "get_dependencies", "get_locked_versions",
+           "get_vendored_source", "source_digest", "get_helm_chart",
            "dump", "selectfile"]
 
 
+class ChartSource(object):
+    """
+    chart源文件的单次遍历结果,每个条目只分类一次:
+        metadata: Chart.yaml内容
+        values: values.yaml内容,不存在时为None
+        templates: templates/下的文件[(相对路径, 内容)]
+        files: 其他需要打包的文件[(相对路径, 内容)]
+        subcharts: charts/下的条目[(名称, 位置)],目录不再向下遍历;
+                   位置为路径(目录源),压缩包内容bytes或ChartSource(压缩包源)
+        entries: 除charts/外所有文件{相对路径: 内容}
+    """
+    __slots__ = ('metadata', 'values', 'templates', 'files', 'subcharts',
+                 'entries')
+
+    def __init__(self):
+        self.metadata = None
+        self.values = None
+        self.templates = []
+        self.files = []
+        self.subcharts = []
+        self.entries = {}
+
+    def add(self, relpath, data):
+        """classify one file of the chart"""
+        self.entries[relpath] = data
+        if relpath == "Chart.yaml":
+            self.metadata = data
+        elif relpath == "values.yaml":
+            self.values = data
+        elif relpath.startswith("templates/"):
+            self.templates.append((relpath, data))
+        elif ChartBuilder.selectfile(relpath):
+            self.files.append((relpath, data))
+
+    @classmethod
+    def scan(cls, directory):
+        """
+        使用os.scandir单次遍历chart目录,
+        遍历时应用.helmignore规则,被忽略的目录不再向下遍历
+        Args:
+            directory: chart目录
+        Returns:
+            ChartSource对象
+        """
+        source = cls()
+        try:
+            with open(os.path.join(directory, ".helmignore"), "rb") as fd:
+                ignore = helmignore.load(fd.read())
+        except (IOError, OSError):
+            ignore = helmignore.load()
+        stack = [""]
+        while stack:
+            prefix = stack.pop()
+            with os.scandir(os.path.join(directory, prefix)) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+            for entry in entries:
+                relpath = prefix + entry.name
+                is_dir = entry.is_dir(follow_symlinks=False)
+                if ignore.ignored(relpath, is_dir=is_dir):
+                    continue
+                if is_dir:
+                    if relpath == "charts":
+                        with os.scandir(entry.path) as it:
+                            source.subcharts.extend(
+                                (sub.name, sub.path)
+                                for sub in sorted(it, key=lambda sub: sub.name)
+                                if not ignore.ignored("charts/" + sub.name,
+                                                      is_dir=sub.is_dir()))
+                    else:
+                        stack.append(relpath + "/")
+                elif entry.is_file():
+                    with open(entry.path, "rb") as fd:
+                        source.add(relpath, fd.read())
+        return source
+
+    @classmethod
+    def from_members(cls, members):
+        """
+        根据chart内的文件构建ChartSource,charts/下的目录递归构建.
+        .helmignore可能出现在任意位置,因此读取全部文件后再过滤
+        Args:
+            members: (相对路径, 内容)的可迭代对象
+        Returns:
+            ChartSource对象
+        """
+        source = cls()
+        nested = {}
+        members = list(members)
+        ignore = helmignore.load(dict(members).get(".helmignore", b""))
+        for relpath, data in members:
+            if ignore.ignored_file(relpath):
+                continue
+            if relpath.startswith("charts/"):
+                name, sep, subpath = relpath[len("charts/"):].partition("/")
+                if sep:
+                    nested.setdefault(name, []).append((subpath, data))
+                elif name:
+                    source.subcharts.append((name, data))
+            else:
+                source.add(relpath, data)
+        for name, sub_members in nested.items():
+            source.subcharts.append((name, cls.from_members(sub_members)))
+        source.subcharts.sort(key=lambda subchart: subchart[0])
+        return source
+
+    @classmethod
+    def from_archive(cls, location):
+        """
+        单次流式读取chart压缩包,不解压到临时目录
+        Args:
+            location: .tgz路径(str),压缩包内容(bytes)或文件对象
+        Returns:
+            ChartSource对象
+        """
+        if isinstance(location, bytes):
+            fileobj = io.BytesIO(location)
+        elif isinstance(location, str):
+            fileobj = open(location, "rb")
+        else:
+            fileobj = location
+
+        def members(tar):
+            for member in tar:
+                if not member.isfile():
+                    continue
+                # strip the top level <chart>/ directory
+                _, sep, relpath = member.name.lstrip("./").partition("/")
+                if sep and relpath:
+                    yield relpath, tar.extractfile(member).read()
+
+        try:
+            with tarfile.open(mode="r|*", fileobj=fileobj) as tar:
+                return cls.from_members(members(tar))
+        except tarfile.TarError as e:
+            raise CustomError("Invalid chart archive: {}".format(e))
+        finally:
+            if fileobj is not location:
+                fileobj.close()
+
+    def update_digest(self, digest):
+        """
+        将所有文件的路径和内容写入hashlib对象,charts/下的目录递归计算
+        Args:
+            digest: hashlib对象
+        """
+        for relpath in sorted(self.entries):
+            data = self.entries[relpath]
+            digest.update("{}\0{}\0".format(relpath, len(data)).encode("utf-8"))
+            digest.update(data)
+        for name, location in self.subcharts:
+            digest.update("charts/{}\0".format(name).encode("utf-8"))
+            if isinstance(location, ChartSource):
+                location.update_digest(digest)
+            elif isinstance(location, bytes):
+                digest.update(location)
+            elif os.path.isdir(location):
+                ChartSource.scan(location).update_digest(digest)
+            elif os.path.isfile(location):
+                with open(location, "rb") as fd:
+                    for chunk in iter(lambda: fd.read(64 * 1024), b""):
+                        digest.update(chunk)
+
+
 class ChartBuilder(object):
     """
     This class handles taking chart intentions as a paramter and
@@ -34,8 +210,14 @@ class ChartBuilder(object):
 
     It also processes chart source declarations, fetching chart
     source from external resources where necessary
+
+    dependency_workers: 并发获取dependencies的线程数
+    build_cache: 进程级的chart构建缓存(cache.ChartBuildCache),为None时不缓存
     """
 
+    dependency_workers = DEPENDENCY_WORKERS
+    build_cache = ChartBuildCache()
+
     def __init__(self, chart):
         """
         构造函数,目的是生成tiller所需的chart数据
@@ -46,12 +228,23 @@ class ChartBuilder(object):
         注意chart的格式(dict):
             1. {'name': 'mongodb', 'source': {'type': 'directory', 'location': '/tmp/pyhelm-kibwtj8d/mongodb'}}
             2. {'name': 'mongodb', 'source': {'type': 'repo', 'version':'0.0.0', 'location': 'http://test.com/charts'}}
+            3. {'name': 'mongodb', 'source': {'type': 'archive', 'location': '/tmp/mongodb-0.0.0.tgz'}}
         使用第二种格式必须制定version(推荐使用2).
+        archive类型的location可以是.tgz路径,压缩包内容(bytes)或文件对象,
+        直接在内存中读取,不解压到临时目录.
 
         """
         # cache for generated protoc chart object
         self._helm_chart = None
 
+        # (repository, name, version) -> Future of dependency chart,
+        # shared by the whole dependency tree
+        self._dependency_futures = {}
+
+        # lazily scanned chart source and charts/ directory
+        self._source = None
+        self._vendored = None
+
         # store chart schema
         self.chart = dotify(chart)
 
@@ -125,25 +318,36 @@ class ChartBuilder(object):
         return n[0]
 
     @staticmethod
-    def generate_values(valuesfile="", values=None):
+    def generate_values(valuesfile="", values=None, set_values=(),
+                        set_string=(), set_file=()):
         """生成对应的value参数,以便在tiller升级和安装过程中替换值
+        values中的所有key先插入同一棵前缀树,再与valuesfile单次合并,
+        key支持a.b[0].c和转义的a\\.b,值为None时删除对应的key
         Args:
             valuesfile: yaml格式的数据(包括"\n")(str)
-            valuesfile: 默认None,可接受的类型为dict
+            values: 默认None,可接受的类型为dict,例如{"server.port": 80}
+            set_values: helm --set表达式(str或list),例如"a=1,b={x,y}"
+            set_string: helm --set-string表达式(str或list)
+            set_file: helm --set-file表达式(str或list),值为文件路径
 
+        表达式按values, set_values, set_string, set_file的顺序应用,
+        编译结果按表达式字符串缓存
         Returns:
             返回tiller可接受的config对象
         """
 
-        if values is None:
-            values = {}
         if len(valuesfile):
-            base_values = yaml.safe_load(valuesfile)
+            base_values = yaml.safe_load(valuesfile) or {}
         else:
             base_values = {}
-        for key, val in values.items():
-            base_values = ChartBuilder.coalesceTables(base_values,
-                                                      ChartBuilder.pathtomap(key, val))
+        trie = ValuesTrie(values)
+        for kind, expressions in (('set', set_values), ('string', set_string),
+                                  ('file', set_file)):
+            if isinstance(expressions, str):
+                expressions = [expressions]
+            for expression in expressions:
+                compile_set(expression, kind).update(trie)
+        base_values = trie.merge(base_values)
         if len(base_values.keys()):
             return Config(raw=yaml.safe_dump(base_values,
                                              default_flow_style=False))
@@ -162,12 +366,22 @@ class ChartBuilder(object):
             raise CustomError(
                 "Need source type for chart {}".format(self.chart.name))
 
+        # only directories created by pyhelm are removed by source_cleanup
+        self._source_is_tmp = self.chart.source.type == 'repo'
         if self.chart.source.type == 'repo':
             self._source_tmp_dir = RepoUtils.from_repo(self.chart.source.location,
                                                        self.chart.name,
                                                        self.chart.version)
         elif self.chart.source.type == 'directory':
             self._source_tmp_dir = self.chart.source.location
+        elif self.chart.source.type == 'archive':
+            location = self.chart.source.location
+            if isinstance(location, ChartSource):
+                self._source = location
+            else:
+                self._source = ChartSource.from_archive(location)
+            self._source_tmp_dir = None
+            return None
 
         else:
             raise CustomError("Unknown source type {} for chart {}".format(
@@ -178,9 +392,22 @@ class ChartBuilder(object):
     def source_cleanup(self):
         '''Cleanup source
 
-        清理临时的chart文件目录
+        清理临时的chart文件目录,directory类型的源目录不会被删除
+        '''
+        if self._source_is_tmp:
+            RepoUtils.source_cleanup(self._source_tmp_dir)
+
+    def load_source(self):
         '''
-        RepoUtils.source_cleanup(self._source_tmp_dir)
+        单次遍历chart源目录,结果会被缓存
+        Args:
+
+        Returns:
+            ChartSource对象
+        '''
+        if self._source is None:
+            self._source = ChartSource.scan(self.source_directory)
+        return self._source
 
     def get_metadata(self):
         '''Process metadata
@@ -191,8 +418,11 @@ class ChartBuilder(object):
             返回tiller所需的metadata对象
         '''
         # extract Chart.yaml to construct metadata
-        chart_yaml = dotify(yaml.load(open(
-            os.path.join(self.source_directory, 'Chart.yaml')).read()))
+        source = self.load_source()
+        if source.metadata is None:
+            raise CustomError("Chart.yaml not found for chart {}".format(
+                self.chart.name))
+        chart_yaml = dotify(yaml.safe_load(source.metadata))
 
         # construct Metadata object
         return Metadata(
@@ -209,14 +439,8 @@ class ChartBuilder(object):
         Returns:
             返回tiller所需的文件对象列表
         '''
-        file_list = []
-        for root, _, files in os.walk(self.source_directory, topdown=True):
-            for tpl_file in files:
-                relativepath = os.path.relpath(os.path.join(root, tpl_file), self.source_directory)
-                if self.selectfile(relativepath):
-                    file_list.append(Any(type_url=relativepath, value=open(os.path.join(root, tpl_file), "rb").read()))
-
-        return file_list
+        return [Any(type_url=relativepath, value=data)
+                for relativepath, data in self.load_source().files]
 
     def get_values(self):
         '''
@@ -229,11 +453,8 @@ class ChartBuilder(object):
         '''
 
         # create config object representing unmarshaled values.yaml
-        if os.path.exists(os.path.join(self.source_directory, 'values.yaml')):
-            raw_values = open(os.path.join(self.source_directory,
-                                           'values.yaml')).read()
-        else:
-            raw_values = ''
+        values = self.load_source().values
+        raw_values = values.decode("utf-8") if values is not None else ''
 
         return Config(raw=raw_values)
 
@@ -248,45 +469,146 @@ class ChartBuilder(object):
         '''
         # process all files in templates/ as a template to attach to the chart
         # building a Template object
-        #import ipdb; ipdb.set_trace()
-        templates = []
-        if not os.path.exists(os.path.join(self.source_directory, 'templates')):
-            pass
-        for root, _, files in os.walk(os.path.join(self.source_directory,
-                                                   'templates'), topdown=True):
-            for tpl_file in files:
-                tname = os.path.relpath(os.path.join(root, tpl_file), self.source_directory)
-
-                templates.append(Template(name=tname,
-                                          data=open(os.path.join(root,
-                                                                 tpl_file),
-                                                    'rb').read()))
-        return templates
+        return [Template(name=tname, data=data)
+                for tname, data in self.load_source().templates]
 
     def get_dependencies(self):
         """
         获取chart的dependecies数据
+        requirements.lock存在时使用其中锁定的版本,charts/目录下已有
+        满足版本的chart时直接使用,否则从repository下载
         Args:
 
         Returns:
             返回tiller所需的dependcies对象
         """
-        dependencies = []
-        if os.path.exists(os.path.join(self.source_directory, "requirements.yaml")):
-            with open(os.path.join(self.source_directory, "requirements.yaml")) as fd:
-                dependencies_info = yaml.safe_load(fd.read())
-                if dependencies_info:
-                    return [ChartBuilder({'name': item["name"],
-                                          'version': item["version"],
-                                          'source': {'type': 'repo',
-                                                     'location': item["repository"]}}).get_helm_chart()
-                            for item in dependencies_info["dependencies"]]
+        items = self._dependency_items()
+        if not items:
+            return []
+        workers = max(min(self.dependency_workers, len(items)), 1)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(self._build_dependency, items))
+
+    def _dependency_items(self):
+        """
+        返回requirements.yaml中的dependencies,版本替换为requirements.lock中锁定的版本
+        """
+        requirements = self.load_source().entries.get("requirements.yaml")
+        if requirements is None:
+            return []
+        dependencies_info = yaml.safe_load(requirements)
+        if not dependencies_info or not dependencies_info.get("dependencies"):
+            return []
+        locked = self.get_locked_versions()
+        return [dict(item, version=locked.get(item["name"], item["version"]))
+                for item in dependencies_info["dependencies"]]
+
+    def get_locked_versions(self):
+        """
+        获取requirements.lock中锁定的版本
+        Args:
 
-                else:
-                    return dependencies
+        Returns:
+            {chart名称: 版本}字典,requirements.lock不存在时返回空字典
+        """
+        lock = self.load_source().entries.get("requirements.lock")
+        if lock is None:
+            return {}
+        lock_info = yaml.safe_load(lock) or {}
+        return dict((item["name"], str(item["version"]))
+                    for item in lock_info.get("dependencies") or [])
+
+    def get_vendored_source(self, name, version):
+        """
+        在charts/目录中查找满足版本的chart(charts/<name>/或charts/<name>-<version>.tgz)
+        Args:
+            name: chart名称
+            version: 版本或版本约束
 
+        Returns:
+            ChartBuilder的source字典,不存在时返回None
+        """
+        if self._vendored is None:
+            self._vendored = []
+            for entry_name, location in self.load_source().subcharts:
+                if isinstance(location, ChartSource):
+                    if location.metadata is None:
+                        continue
+                    info = yaml.safe_load(location.metadata) or {}
+                    self._vendored.append((info.get("name", entry_name),
+                                           str(info.get("version", "")),
+                                           {'type': 'archive', 'location': location}))
+                elif isinstance(location, bytes) or os.path.isfile(location):
+                    if entry_name.endswith(".tgz"):
+                        self._vendored.append((entry_name[:-len(".tgz")], None,
+                                               {'type': 'archive', 'location': location}))
+                elif os.path.exists(os.path.join(location, "Chart.yaml")):
+                    with open(os.path.join(location, "Chart.yaml")) as fd:
+                        info = yaml.safe_load(fd.read()) or {}
+                    self._vendored.append((info.get("name", entry_name),
+                                           str(info.get("version", "")),
+                                           {'type': 'directory', 'location': location}))
+
+        candidates = []
+        for chart_name, chart_version, source in self._vendored:
+            if chart_version is None:
+                # <name>-<version>.tgz
+                prefix = name + "-"
+                if not chart_name.startswith(prefix) or \
+                        parse_version(chart_name[len(prefix):]) is None:
+                    continue
+                chart_name, chart_version = name, chart_name[len(prefix):]
+            if chart_name == name:
+                candidates.append((chart_version, source))
+        if not candidates:
+            return None
+        found = VersionIndex(candidates, version=lambda x: x[0]).query(version)
+        return found[1] if found is not None else None
+
+    def _build_dependency(self, item):
+        """
+        构建单个dependency,优先使用charts/目录中的chart;
+        否则版本约束先解析为具体版本,整个依赖树中相同的repository/name/version只构建一次
+        Args:
+            item: requirements.yaml中的dependency(dict)
+
+        Returns:
+            dependency的chart对象
+        """
+        source = self.get_vendored_source(item["name"], item["version"])
+        if source is not None:
+            LOG.debug("Dependency %s-%s uses vendored chart", item["name"],
+                      item["version"])
+            builder = ChartBuilder({'name': item["name"], 'source': source})
+            builder._dependency_futures = self._dependency_futures
+            return builder.get_helm_chart()
+
+        metadata = RepoUtils.repo_index(item["repository"]).resolve(
+            item["name"], item["version"])
+        if metadata is None:
+            raise CustomError("Dependency {} version {} not found in {}".format(
+                item["name"], item["version"], item["repository"]))
+        key = (item["repository"], item["name"], metadata.version)
+        with _DEPENDENCY_LOCK:
+            future = self._dependency_futures.get(key)
+            owner = future is None
+            if owner:
+                future = self._dependency_futures[key] = Future()
+
+        if owner:
+            try:
+                builder = ChartBuilder({'name': item["name"],
+                                        'version': metadata.version,
+                                        'source': {'type': 'repo',
+                                                   'location': item["repository"]}})
+                builder._dependency_futures = self._dependency_futures
+                future.set_result(builder.get_helm_chart())
+            except Exception as e:
+                future.set_exception(e)
         else:
-            return dependencies
+            LOG.debug("Dependency %s-%s is already being built", item["name"],
+                      metadata.version)
+        return future.result()
 
     def get_helm_chart(self):
         '''
@@ -301,6 +623,16 @@ class ChartBuilder(object):
         if self._helm_chart:
             return self._helm_chart
 
+        cache = self.build_cache
+        if cache is not None:
+            key = self.source_digest()
+            data = cache.get(key)
+            if data is not None:
+                LOG.debug("Chart %s build cache hit", self.chart.name)
+                self._helm_chart = Chart.FromString(data)
+                self.source_cleanup()
+                return self._helm_chart
+
         helm_chart = Chart(
             metadata=self.get_metadata(),
             templates=self.get_templates(),
@@ -309,11 +641,35 @@ class ChartBuilder(object):
             files=self.get_files(),
         )
 
+        if cache is not None:
+            cache.put(key, helm_chart.SerializeToString())
         self._helm_chart = helm_chart
         self.source_cleanup()
         return helm_chart
 
-    def selectfile(self, filepath):
+    def source_digest(self):
+        '''
+        计算chart源文件内容的sha256,作为构建缓存的key
+        包含所有文件的路径和内容,以及repository中dependencies解析后的具体版本
+        Args:
+
+        Returns:
+            sha256字符串
+        '''
+        digest = hashlib.sha256()
+        self.load_source().update_digest(digest)
+        for item in self._dependency_items():
+            if self.get_vendored_source(item["name"], item["version"]) is not None:
+                continue
+            metadata = RepoUtils.repo_index(item["repository"]).resolve(
+                item["name"], item["version"])
+            digest.update("{}@{}@{}\0".format(
+                item["repository"], item["name"],
+                metadata.version if metadata is not None else item["version"]).encode("utf-8"))
+        return digest.hexdigest()
+
+    @staticmethod
+    def selectfile(filepath):
 
         if filepath == "Chart.yaml" or filepath == "values.yaml" or filepath =="values.toml" or filepath.startswith("templates/") or filepath.startswith("charts/"):
             return False
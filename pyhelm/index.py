@@ -0,0 +1,135 @@
+#-*- coding:utf-8 -*-
+"""
+index 包含repo index.yaml的紧凑表示
+"""
+from types import MappingProxyType
+
+import yaml
+
+from utils.semver import VersionIndex
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+__all__ = ["RepoIndex", "ChartVersion", "parse", "load", "charts",
+           "versions", "search", "resolve"]
+
+
+class _IndexLoader(SafeLoader):
+    """SafeLoader keeping int/float scalars as their original text
+
+    未加引号的version: 1.10不会被解析为浮点数1.1
+    """
+
+
+_IndexLoader.add_constructor('tag:yaml.org,2002:int', _IndexLoader.construct_yaml_str)
+_IndexLoader.add_constructor('tag:yaml.org,2002:float', _IndexLoader.construct_yaml_str)
+
+
+class ChartVersion(object):
+    """One version entry of a chart in index.yaml
+
+    只保留下载chart所需的字段
+    """
+    __slots__ = ('name', 'version', 'digest', 'urls')
+
+    def __init__(self, name, version, digest=None, urls=()):
+        self.name = name
+        self.version = version
+        self.digest = digest
+        self.urls = urls
+
+    def __repr__(self):
+        return "<ChartVersion {}-{}>".format(self.name, self.version)
+
+
+class RepoIndex(object):
+    """Compact repo index
+
+    entries: {chart名称: (ChartVersion, ...)}
+    每个chart的semver索引在第一次resolve时建立并缓存
+    兼容旧版本repo_index返回的dict,支持只读的index['entries']
+    """
+    __slots__ = ('entries', '_versions_index', '_entries_view')
+
+    def __init__(self, entries):
+        self.entries = entries
+        self._versions_index = {}
+        self._entries_view = None
+
+    @classmethod
+    def from_dict(cls, index_data):
+        """build RepoIndex from index.yaml的dict格式数据"""
+        entries = {}
+        for name, items in (index_data.get('entries') or {}).items():
+            entries[name] = tuple(
+                ChartVersion(name, str(item['version']), item.get('digest'),
+                             tuple(item.get('urls') or ()))
+                for item in items or ())
+        return cls(entries)
+
+    @classmethod
+    def parse(cls, content):
+        """parse index.yaml content,libyaml可用时使用C实现的loader
+
+        Args:
+            content: index.yaml内容(bytes/str)
+
+        Returns:
+            RepoIndex对象
+        """
+        return cls.from_dict(yaml.load(content, Loader=_IndexLoader) or {})
+
+    @classmethod
+    def load(cls, index_data):
+        """return RepoIndex for RepoIndex or index.yaml的dict格式数据"""
+        if isinstance(index_data, cls):
+            return index_data
+        return cls.from_dict(index_data)
+
+    def charts(self):
+        """return all chart names"""
+        return self.entries.keys()
+
+    def versions(self, chart):
+        """return ChartVersion tuple of chart,chart不存在时抛出KeyError"""
+        return self.entries[chart]
+
+    def resolve(self, chart, constraint=None):
+        """return the highest ChartVersion matching constraint
+
+        Args:
+            chart: chart名称(str)
+            constraint: 版本或版本约束,例如1.2.3, ~1.2, ^2, >=1.0 <2.0, latest
+
+        Returns:
+            ChartVersion对象,chart不存在或没有满足约束的版本时返回None
+        """
+        if chart not in self.entries:
+            return None
+        versions_index = self._versions_index.get(chart)
+        if versions_index is None:
+            versions_index = VersionIndex(self.versions(chart))
+            self._versions_index[chart] = versions_index
+        return versions_index.query(constraint)
+
+    def search(self, search_string):
+        """return chart names containing search_string"""
+        return [name for name in self.entries if search_string in name]
+
+    def __contains__(self, chart):
+        return chart in self.entries
+
+    def __getitem__(self, key):
+        """read-only index['entries'] view, {chart名称: ({'name', 'version', 'digest', 'urls'}, ...)}"""
+        if key != 'entries':
+            raise KeyError(key)
+        if self._entries_view is None:
+            self._entries_view = MappingProxyType(dict(
+                (name, tuple(MappingProxyType({'name': item.name, 'version': item.version,
+                                               'digest': item.digest, 'urls': item.urls})
+                             for item in items))
+                for name, items in self.entries.items()))
+        return self._entries_view
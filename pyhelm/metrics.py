@@ -0,0 +1,356 @@
+#-*- coding:utf-8 -*-
+"""
+metrics 统计tiller rpc的耗时,请求/响应大小,状态码以及进行中的请求数
+
+    metrics = RpcMetrics(callback=lambda event: print(event))
+    tiller = Tiller(host, metrics=metrics)
+    print(metrics.prometheus())
+"""
+import asyncio
+import bisect
+import logging
+import threading
+import time
+from collections import namedtuple
+
+import grpc
+from grpc import aio
+
+LOG = logging.getLogger('pyhelm')
+# 耗时直方图的上界(秒)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60, 120, 300)
+METRICS_PREFIX = 'pyhelm_tiller_rpc'
+
+__all__ = ["RpcMetrics", "RpcEvent", "MetricsInterceptor", "AsyncMetricsInterceptor",
+           "AsyncStreamMetricsInterceptor", "aio_interceptors", "started", "finished", "received", "snapshot", "prometheus", "reset"]
+
+
+RpcEvent = namedtuple('RpcEvent', ['method', 'code', 'latency', 'request_size',
+                                   'response_size', 'release'])
+RpcEvent.__doc__ = '''单次rpc的统计,code为grpc.StatusCode,latency单位秒,大小单位字节,
+release为请求中的release名称(install时为空则使用chart名称)'''
+
+
+def _method_name(method):
+    """/hapi.services.tiller.ReleaseService/InstallRelease -> InstallRelease"""
+    if isinstance(method, bytes):
+        method = method.decode('utf-8')
+    return method.rsplit('/', 1)[-1]
+
+
+def _release_name(request):
+    name = getattr(request, 'name', '')
+    if not name and hasattr(request, 'chart'):
+        name = request.chart.metadata.name
+    return name
+
+
+class _MethodStats(object):
+    __slots__ = ('buckets', 'latency_sum', 'count', 'codes', 'request_bytes',
+                 'response_bytes', 'in_flight')
+
+    def __init__(self, size):
+        self.buckets = [0] * size
+        self.latency_sum = 0.0
+        self.count = 0
+        self.codes = {}
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.in_flight = 0
+
+
+class RpcMetrics(object):
+    """Per-method rpc metrics
+
+    每个方法保存耗时直方图,各状态码的次数,请求/响应的总字节数和进行中的请求数.
+    callback不为None时每个rpc结束后以RpcEvent为参数调用.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS, callback=None):
+        """
+        Args:
+            buckets: 耗时直方图的上界(秒),从小到大排列
+            callback: 参数为RpcEvent的函数
+        """
+        self.buckets = tuple(sorted(buckets))
+        self.callback = callback
+        self._methods = {}
+        self._lock = threading.Lock()
+
+    def _stats(self, method):
+        stats = self._methods.get(method)
+        if stats is None:
+            stats = self._methods[method] = _MethodStats(len(self.buckets) + 1)
+        return stats
+
+    def started(self, method, request_size):
+        """记录rpc开始"""
+        with self._lock:
+            stats = self._stats(method)
+            stats.in_flight += 1
+            stats.request_bytes += request_size
+
+    def received(self, method, response_size):
+        """记录收到的响应大小"""
+        with self._lock:
+            self._stats(method).response_bytes += response_size
+
+    def finished(self, method, code, latency, request_size=0, response_size=0,
+                 release=''):
+        """记录rpc结束
+        Args:
+            method: 方法名
+            code: grpc.StatusCode
+            latency: 耗时(秒)
+            request_size: 请求大小(字节)
+            response_size: 响应大小(字节),stream为已读取的响应大小
+            release: release名称
+        """
+        with self._lock:
+            stats = self._stats(method)
+            stats.in_flight -= 1
+            stats.buckets[bisect.bisect_left(self.buckets, latency)] += 1
+            stats.latency_sum += latency
+            stats.count += 1
+            stats.codes[code] = stats.codes.get(code, 0) + 1
+        if self.callback is not None:
+            try:
+                self.callback(RpcEvent(method, code, latency, request_size,
+                                       response_size, release))
+            except Exception as e:
+                LOG.error("Rpc metrics callback failed: %s", e)
+
+    def snapshot(self):
+        """
+        Returns:
+            {方法名: {'count', 'latency_sum', 'buckets': [(上界, 累计次数)],
+                      'codes': {状态码名称: 次数}, 'request_bytes',
+                      'response_bytes', 'in_flight'}}
+        """
+        with self._lock:
+            result = {}
+            for method, stats in self._methods.items():
+                cumulative, total = [], 0
+                for bound, count in zip(self.buckets + (float('inf'),), stats.buckets):
+                    total += count
+                    cumulative.append((bound, total))
+                result[method] = {
+                    'count': stats.count,
+                    'latency_sum': stats.latency_sum,
+                    'buckets': cumulative,
+                    'codes': dict((code.name, n) for code, n in stats.codes.items()),
+                    'request_bytes': stats.request_bytes,
+                    'response_bytes': stats.response_bytes,
+                    'in_flight': stats.in_flight,
+                }
+            return result
+
+    def prometheus(self, prefix=METRICS_PREFIX):
+        """
+        Args:
+            prefix: 指标名称前缀
+        Returns:
+            Prometheus text exposition format(str)
+        """
+        snapshot = sorted(self.snapshot().items())
+        lines = [
+            "# HELP {}_duration_seconds Tiller rpc latency".format(prefix),
+            "# TYPE {}_duration_seconds histogram".format(prefix),
+        ]
+        for method, stats in snapshot:
+            for bound, count in stats['buckets']:
+                le = "+Inf" if bound == float('inf') else repr(float(bound))
+                lines.append('{}_duration_seconds_bucket{{method="{}",le="{}"}} {}'.format(
+                    prefix, method, le, count))
+            lines.append('{}_duration_seconds_sum{{method="{}"}} {}'.format(
+                prefix, method, stats['latency_sum']))
+            lines.append('{}_duration_seconds_count{{method="{}"}} {}'.format(
+                prefix, method, stats['count']))
+        lines.append("# HELP {}_total Finished tiller rpcs by status code".format(prefix))
+        lines.append("# TYPE {}_total counter".format(prefix))
+        for method, stats in snapshot:
+            for code, count in sorted(stats['codes'].items()):
+                lines.append('{}_total{{method="{}",code="{}"}} {}'.format(
+                    prefix, method, code, count))
+        for name, key, kind, doc in (
+                ('request_bytes_total', 'request_bytes', 'counter', 'Serialized request bytes'),
+                ('response_bytes_total', 'response_bytes', 'counter', 'Serialized response bytes'),
+                ('in_flight', 'in_flight', 'gauge', 'Tiller rpcs in flight')):
+            lines.append("# HELP {}_{} {}".format(prefix, name, doc))
+            lines.append("# TYPE {}_{} {}".format(prefix, name, kind))
+            for method, stats in snapshot:
+                lines.append('{}_{}{{method="{}"}} {}'.format(prefix, name, method, stats[key]))
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        """清空已完成rpc的统计,保留进行中的请求数"""
+        with self._lock:
+            for method, stats in list(self._methods.items()):
+                in_flight = stats.in_flight
+                stats = self._methods[method] = _MethodStats(len(self.buckets) + 1)
+                stats.in_flight = in_flight
+
+
+class _ResponseStream(object):
+    """Response iterator of a unary-stream call recording response sizes"""
+
+    def __init__(self, call, on_response):
+        self._call = call
+        self._on_response = on_response
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        response = next(self._call)
+        self._on_response(response)
+        return response
+
+    def __getattr__(self, name):
+        return getattr(self._call, name)
+
+
+class MetricsInterceptor(grpc.UnaryUnaryClientInterceptor,
+                         grpc.UnaryStreamClientInterceptor):
+    """grpc client interceptor recording RpcMetrics"""
+
+    def __init__(self, metrics=None):
+        """
+        Args:
+            metrics: RpcMetrics,为None时创建新的RpcMetrics
+        """
+        self.metrics = RpcMetrics() if metrics is None else metrics
+
+    def _begin(self, client_call_details, request):
+        method = _method_name(client_call_details.method)
+        request_size = request.ByteSize()
+        self.metrics.started(method, request_size)
+        return method, request_size, time.monotonic()
+
+    def intercept_unary_unary(self, continuation, client_call_details, request):
+        method, request_size, start = self._begin(client_call_details, request)
+
+        def done(outcome):
+            code = outcome.code()
+            response_size = 0
+            if code == grpc.StatusCode.OK:
+                response_size = outcome.result().ByteSize()
+                self.metrics.received(method, response_size)
+            self.metrics.finished(method, code, time.monotonic() - start,
+                                  request_size, response_size, _release_name(request))
+
+        try:
+            outcome = continuation(client_call_details, request)
+        except Exception:
+            self.metrics.finished(method, grpc.StatusCode.UNKNOWN,
+                                  time.monotonic() - start, request_size)
+            raise
+        outcome.add_done_callback(done)
+        return outcome
+
+    def intercept_unary_stream(self, continuation, client_call_details, request):
+        method, request_size, start = self._begin(client_call_details, request)
+        received = [0]
+
+        def on_response(response):
+            size = response.ByteSize()
+            received[0] += size
+            self.metrics.received(method, size)
+
+        def done(call):
+            self.metrics.finished(method, call.code(), time.monotonic() - start,
+                                  request_size, received[0], _release_name(request))
+
+        try:
+            call = continuation(client_call_details, request)
+        except Exception:
+            self.metrics.finished(method, grpc.StatusCode.UNKNOWN,
+                                  time.monotonic() - start, request_size)
+            raise
+        call.add_done_callback(done)
+        return _ResponseStream(call, on_response)
+
+
+class AsyncMetricsInterceptor(aio.UnaryUnaryClientInterceptor):
+    """grpc.aio unary-unary client interceptor recording RpcMetrics
+
+    grpc.aio按类型区分拦截器,一个对象只会作为一种拦截器注册,
+    stream请求需要同时使用AsyncStreamMetricsInterceptor,见aio_interceptors
+    """
+
+    def __init__(self, metrics=None):
+        """
+        Args:
+            metrics: RpcMetrics,为None时创建新的RpcMetrics
+        """
+        self.metrics = RpcMetrics() if metrics is None else metrics
+
+    async def intercept_unary_unary(self, continuation, client_call_details, request):
+        method = _method_name(client_call_details.method)
+        request_size = request.ByteSize()
+        self.metrics.started(method, request_size)
+        start = time.monotonic()
+        code, response_size = grpc.StatusCode.UNKNOWN, 0
+        try:
+            response = await (await continuation(client_call_details, request))
+            code, response_size = grpc.StatusCode.OK, response.ByteSize()
+            self.metrics.received(method, response_size)
+            return response
+        except aio.AioRpcError as e:
+            code = e.code()
+            raise
+        except asyncio.CancelledError:
+            code = grpc.StatusCode.CANCELLED
+            raise
+        finally:
+            self.metrics.finished(method, code, time.monotonic() - start,
+                                  request_size, response_size, _release_name(request))
+
+
+
+class AsyncStreamMetricsInterceptor(aio.UnaryStreamClientInterceptor):
+    """grpc.aio unary-stream client interceptor recording RpcMetrics"""
+
+    def __init__(self, metrics=None):
+        """
+        Args:
+            metrics: RpcMetrics,为None时创建新的RpcMetrics
+        """
+        self.metrics = RpcMetrics() if metrics is None else metrics
+
+    async def intercept_unary_stream(self, continuation, client_call_details, request):
+        method = _method_name(client_call_details.method)
+        request_size = request.ByteSize()
+        self.metrics.started(method, request_size)
+        start = time.monotonic()
+        try:
+            call = await continuation(client_call_details, request)
+        except BaseException:
+            self.metrics.finished(method, grpc.StatusCode.UNKNOWN,
+                                  time.monotonic() - start, request_size)
+            raise
+
+        async def responses():
+            # 调用方没有读完时记为CANCELLED
+            code, received = grpc.StatusCode.CANCELLED, 0
+            try:
+                async for response in call:
+                    size = response.ByteSize()
+                    received += size
+                    self.metrics.received(method, size)
+                    yield response
+                code = grpc.StatusCode.OK
+            except aio.AioRpcError as e:
+                code = e.code()
+                raise
+            finally:
+                self.metrics.finished(method, code, time.monotonic() - start,
+                                      request_size, received, _release_name(request))
+
+        return responses()
+
+
+def aio_interceptors(metrics):
+    """return grpc.aio interceptors recording unary and stream rpcs into metrics"""
+    return [AsyncMetricsInterceptor(metrics), AsyncStreamMetricsInterceptor(metrics)]
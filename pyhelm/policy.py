@@ -0,0 +1,137 @@
+#-*- coding:utf-8 -*-
+"""
+policy 包含tiller rpc的超时,重试和退避策略
+"""
+import random
+import threading
+import time
+
+import grpc
+
+__all__ = ["CallPolicy", "RetryBudget", "READ_METHODS", "RETRYABLE_CODES", "deposit",
+           "withdraw", "timeout", "begin", "backoff", "retryable", "retry_delay"]
+
+# 只读(幂等)的rpc,失败后可以重试
+READ_METHODS = frozenset(["ListReleases", "GetReleaseStatus", "GetReleaseContent",
+                          "GetHistory", "GetVersion"])
+RETRYABLE_CODES = frozenset([grpc.StatusCode.UNAVAILABLE,
+                             grpc.StatusCode.RESOURCE_EXHAUSTED,
+                             grpc.StatusCode.ABORTED])
+MAX_ATTEMPTS = 3
+INITIAL_BACKOFF = 0.1
+MAX_BACKOFF = 5
+BACKOFF_MULTIPLIER = 2
+# 每个请求为重试预算增加的令牌数,即重试请求最多占正常请求的比例
+RETRY_RATIO = 0.1
+RETRY_TOKENS = 10
+
+
+class RetryBudget(object):
+    """Token bucket limiting retries to a ratio of calls
+
+    每个请求存入ratio个令牌,每次重试取出一个令牌,令牌不足时不再重试,
+    避免tiller不可用时重试把请求量放大max_attempts倍.
+    """
+
+    def __init__(self, ratio=RETRY_RATIO, max_tokens=RETRY_TOKENS):
+        """
+        Args:
+            ratio: 每个请求存入的令牌数(float)
+            max_tokens: 令牌上限,也是初始令牌数(int)
+        """
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = float(max_tokens)
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.tokens = min(self.tokens + self.ratio, self.max_tokens)
+
+    def withdraw(self):
+        """return True if a retry is allowed"""
+        with self._lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class CallPolicy(object):
+    """
+    Deadline/retry policy of tiller rpcs
+
+        policy = CallPolicy(timeouts={'GetReleaseStatus': 5, 'InstallRelease': 600})
+        tiller = Tiller(host, policy=policy)
+
+    deadline包含所有重试以及退避的时间;只有READ_METHODS中的方法在
+    RETRYABLE_CODES错误时使用带随机抖动的指数退避重试.
+    """
+
+    def __init__(self, timeout=None, timeouts=None, max_attempts=MAX_ATTEMPTS,
+                 initial_backoff=INITIAL_BACKOFF, max_backoff=MAX_BACKOFF,
+                 multiplier=BACKOFF_MULTIPLIER, retryable_codes=RETRYABLE_CODES,
+                 idempotent_methods=READ_METHODS, budget=None):
+        """
+        Args:
+            timeout: 默认超时时间(秒),为None时使用Tiller.timeout
+            timeouts: {方法名: 超时时间(秒)},例如{'GetReleaseStatus': 5}
+            max_attempts: 最大尝试次数(包括第一次),1表示不重试(int)
+            initial_backoff: 第一次重试的最大退避时间(秒)
+            max_backoff: 退避时间上限(秒)
+            multiplier: 退避时间的增长倍数
+            retryable_codes: 可重试的grpc.StatusCode
+            idempotent_methods: 可重试的方法名
+            budget: RetryBudget,为None时创建默认的RetryBudget
+        """
+        self.default_timeout = timeout
+        self.timeouts = dict(timeouts or {})
+        self.max_attempts = max(int(max_attempts), 1)
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.multiplier = multiplier
+        self.retryable_codes = frozenset(retryable_codes)
+        self.idempotent_methods = frozenset(idempotent_methods)
+        self.budget = RetryBudget() if budget is None else budget
+
+    def timeout(self, method, default=None):
+        """return timeout(秒) of method"""
+        timeout = self.timeouts.get(method, self.default_timeout)
+        return default if timeout is None else timeout
+
+    def begin(self, method, default=None):
+        """开始一次调用,返回time.monotonic()时间的deadline"""
+        self.budget.deposit()
+        return time.monotonic() + self.timeout(method, default)
+
+    def backoff(self, attempt):
+        """return full jitter backoff(秒) before retry attempt(从0开始)"""
+        ceiling = min(self.max_backoff,
+                      self.initial_backoff * self.multiplier ** attempt)
+        return random.uniform(0, ceiling)
+
+    def retryable(self, method, error):
+        """return True if error of method can be retried, 不检查次数,deadline和重试预算"""
+        if method not in self.idempotent_methods:
+            return False
+        code = error.code() if callable(getattr(error, 'code', None)) else None
+        return code in self.retryable_codes
+
+    def retry_delay(self, method, error, attempt, deadline):
+        """
+        Args:
+            method: 方法名
+            error: grpc.RpcError
+            attempt: 失败的是第几次尝试,从0开始
+            deadline: begin返回的deadline
+        Returns:
+            重试前需要等待的时间(秒),不应重试时返回None
+        """
+        if attempt + 1 >= self.max_attempts or not self.retryable(method, error):
+            return None
+        delay = self.backoff(attempt)
+        if time.monotonic() + delay >= deadline:
+            return None
+        if not self.budget.withdraw():
+            return None
+        return delay
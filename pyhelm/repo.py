@@ -3,29 +3,55 @@
 repo 包含repo处理的简单函数,包括返回chart版本列表
 chart名称列表以及根据字符搜索chart等功能
 """
-try:
-    from StringIO import StringIO
-except ImportError:
-    from io import BytesIO as StringIO
 import os
 import git
 import requests
 import shutil
 import tarfile
 import tempfile
-import yaml
 
+from cache import DigestReader, IndexCache
+from index import RepoIndex
 from utils.exceptions import CustomError
 
-__all__ = ["RepoUtils", "repo_chart", "repo_search", "chart_versions", "repo_index", "from_repo", "git_clone", "source_cleanup"]
+__all__ = ["RepoUtils", "repo_chart", "repo_search", "chart_versions", "repo_index", "from_repo",
+           "stream_extract", "git_clone", "source_cleanup"]
+
+
+def _checked_members(tar):
+    """yield tar members, reject absolute paths, .. and links/special files
+
+    chart压缩包中只应包含普通文件和目录,防止解压到目标目录之外
+    """
+    for member in tar:
+        name = member.name.replace('\\', '/')
+        if name.startswith('/') or '..' in name.split('/'):
+            raise CustomError('Illegal path {} in chart archive'.format(member.name))
+        if not (member.isfile() or member.isdir()):
+            raise CustomError('Unsupported member {} in chart archive'.format(member.name))
+        yield member
+
+
+def _extract(tar, target_dir):
+    """extract chart archive members into target_dir"""
+    if hasattr(tarfile, 'data_filter'):
+        tar.extractall(target_dir, members=_checked_members(tar), filter='data')
+    else:
+        tar.extractall(target_dir, members=_checked_members(tar))
 
 
 class RepoUtils(object):
     """Utils for repo control
     
     该类实现repo的基本分析操作.
+
+    chart_cache: 默认的chart压缩包缓存(cache.ChartCache),为None时不缓存
+    index_cache: index.yaml缓存(cache.IndexCache),为None时每次重新下载
     """
 
+    chart_cache = None
+    index_cache = IndexCache()
+
     @staticmethod
     def repo_chart(index_data):
         """return all item of chart
@@ -33,13 +59,13 @@ class RepoUtils(object):
         return all item for index_data.
 
         Args:
-            index_data: index.yaml的dict格式数据
+            index_data: RepoIndex或index.yaml的dict格式数据
 
         Returns:
             由chart名称所组成的list
 
         """
-        return index_data["entries"].keys()
+        return RepoIndex.load(index_data).charts()
 
     @staticmethod
     def repo_search(index_data, search_string):
@@ -47,18 +73,14 @@ class RepoUtils(object):
          
         搜索包含search_string的chart,并返回列表
         Args:
-            index_data: index.yaml的dict格式数据
+            index_data: RepoIndex或index.yaml的dict格式数据
             search_string: 搜索字符串 
 
         Returns:
             由chart名称所组成的list
 
         """
-        search_result = []
-        for item in index_data["entries"].keys():
-            if item.find(search_string) != -1:
-                search_result.append(item)
-        return search_result
+        return RepoIndex.load(index_data).search(search_string)
 
     @staticmethod
     def chart_versions(index_data, chart_name):
@@ -66,36 +88,38 @@ class RepoUtils(object):
         返回chart_name的所有版本列表 
         
         Args:
-            index_data: index.yaml的dict格式数据(dict)
+            index_data: RepoIndex或index.yaml的dict格式数据
             chart_name: chart_name(str) 
 
         Returns:
             由chart version所组成的list
 
         """
-        chart_all_versions = index_data["entries"][chart_name]
-        chart_version_list = [item["version"] for item in chart_all_versions]
-        return chart_version_list
+        return [item.version for item in
+                RepoIndex.load(index_data).versions(chart_name)]
 
     @staticmethod
     def repo_index(repo_url, timeout=3):
         """Downloads the Chart's repo index
         
-        返回repo_url的字典格式数据 
+        返回repo_url的RepoIndex对象
         
         Args:
             repo_url: repo的链接(str)
             timeout: 请求超时时间
 
         Returns:
-            repo_url的字典数据
+            RepoIndex对象
         """
         index_url = os.path.join(repo_url, 'index.yaml')
+        if RepoUtils.index_cache is not None:
+            return RepoUtils.index_cache.fetch(index_url, RepoIndex.parse,
+                                               timeout=timeout)
         index = requests.get(index_url, timeout=timeout)
-        return yaml.safe_load(index.content)
+        return RepoIndex.parse(index.content)
 
     @staticmethod
-    def from_repo(repo_url, chart, version=None, timeout=3):
+    def from_repo(repo_url, chart, version=None, timeout=3, cache=None):
         """Downloads the chart from a repo.
 
         返回下载并解压后的chart目录 
@@ -103,30 +127,79 @@ class RepoUtils(object):
         Args:
             repo_url: repo的链接(str)
             chart: chart名称(str)
-            version: chart版本(str)
+            version: chart版本或版本约束(str),例如1.2.3, ~1.2, ^2, >=1.0 <2.0,
+                     为None时使用最新的正式版本
             timeout: 请求超时时间(int)
+            cache: chart压缩包缓存(cache.ChartCache),默认使用RepoUtils.chart_cache
 
         Returns:
             返回下载并解压后的chart目录 
         """
-        _tmp_dir = tempfile.mkdtemp(prefix='pyhelm-', dir='/tmp')
-        index = RepoUtils.repo_index(repo_url)
+        index = RepoUtils.repo_index(repo_url, timeout=timeout)
 
-        if chart not in index['entries']:
+        if chart not in index:
             raise CustomError('Chart not found in repo')
 
-        versions = index['entries'][chart]
+        metadata = index.resolve(chart, version)
+        if metadata is None:
+            raise CustomError('Chart {} version {} not found in repo'.format(
+                chart, version))
+        if cache is None:
+            cache = RepoUtils.chart_cache
+        _tmp_dir = tempfile.mkdtemp(prefix='pyhelm-', dir='/tmp')
+        try:
+            for url in metadata.urls:
+                if cache is not None:
+                    key = cache.key(url, metadata.version, metadata.digest)
+                    path = cache.get(key)
+                    if path is None:
+                        with requests.get(url, stream=True, timeout=timeout) as req:
+                            req.raise_for_status()
+                            req.raw.decode_content = True
+                            try:
+                                path = cache.put(key, req.raw, metadata.digest)
+                            except ValueError as e:
+                                raise CustomError(str(e))
+                    with tarfile.open(path, mode="r:*") as tar:
+                        _extract(tar, _tmp_dir)
+                    return os.path.join(_tmp_dir, chart)
+                RepoUtils.stream_extract(url, _tmp_dir, metadata.digest, timeout)
+                return os.path.join(_tmp_dir, chart)
+        except Exception:
+            shutil.rmtree(_tmp_dir, ignore_errors=True)
+            raise
+
+    @staticmethod
+    def stream_extract(url, target_dir, digest=None, timeout=3):
+        """Download and extract chart archive without buffering it.
 
-        if version is not None:
-            versions = filter(lambda k: k['version'] == version, versions)
+        以流的方式边下载边解压到target_dir下的临时目录,同时计算sha256并与digest比较,
+        校验通过后才移动到target_dir
+        Args:
+            url: chart压缩包链接(str)
+            target_dir: 解压目录(str)
+            digest: index.yaml中的sha256(str),为空时不校验
+            timeout: 请求超时时间(int)
 
-        metadata = sorted(versions, key=lambda x: x['version'])[0]
-        for url in metadata['urls']:
-            req = requests.get(url, stream=True, timeout=timeout)
-            fobj = StringIO(req.content)
-            tar = tarfile.open(mode="r:*", fileobj=fobj)
-            tar.extractall(_tmp_dir)
-            return os.path.join(_tmp_dir, chart)
+        Returns:
+        """
+        staging_dir = tempfile.mkdtemp(prefix='.pyhelm-', dir=target_dir)
+        try:
+            with requests.get(url, stream=True, timeout=timeout) as req:
+                req.raise_for_status()
+                req.raw.decode_content = True
+                reader = DigestReader(req.raw)
+                with tarfile.open(mode="r|*", fileobj=reader) as tar:
+                    _extract(tar, staging_dir)
+                reader.drain()
+            if not reader.verify(digest):
+                raise CustomError("Digest mismatch for {}: expected {}, got {}".format(
+                    url, digest, reader.hexdigest()))
+            for name in os.listdir(staging_dir):
+                os.replace(os.path.join(staging_dir, name),
+                           os.path.join(target_dir, name))
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
 
     @staticmethod
     def git_clone(repo_url, branch='master'):
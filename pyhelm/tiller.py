@@ -1,7 +1,12 @@
 # -*- coding:utf-8 -*-
+import itertools
 import logging
 import os
 import sys
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
 
 import yaml
 
@@ -11,7 +16,8 @@ from hapi.services.tiller_pb2 import (GetHistoryRequest,
                                       GetReleaseContentRequest,
                                       GetReleaseStatusRequest,
                                       GetVersionRequest, InstallReleaseRequest,
-                                      ListReleasesRequest, ReleaseServiceStub,
+                                      ListReleasesRequest, ListSort,
+                                      ReleaseServiceStub,
                                       RollbackReleaseRequest,
                                       TestReleaseRequest,
                                       UninstallReleaseRequest,
@@ -22,6 +28,10 @@ from hapi.services.tiller_pb2 import (GetHistoryRequest,
 sys.path.insert(0, os.path.split(
     os.path.abspath(os.path.dirname(__file__)))[0])
 
+from utils.exceptions import CustomError
+from cache import ReleaseCache
+from policy import CallPolicy
+from metrics import MetricsInterceptor, RpcMetrics
 
 LOG = logging.getLogger('pyhelm')
 TILLER_PORT = 44134
@@ -30,11 +40,188 @@ TILLER_TIMEOUT = 300
 REQUEST_TIMEOUT = 5
 RELEASE_LIMIT = 0
 MAX_HISTORY = 64
-
-__all__ = ["Tiller", "metadata", "get_channel", "tiller_status", "get_release_content",
-           "get_release_status", "list_releases", "list_charts", "update_release",
+LIST_PAGE_SIZE = 256
+# list_charts/chart_cleanup等只需要release的概要信息
+STATUS_CONCURRENCY = 64
+CLEANUP_WORKERS = 8
+RELEASE_SUMMARY_FIELDS = ("name", "version", "namespace", "info.status.code")
+CHANNEL_POOL_SIZE = 1
+# tiller默认最大接收消息为20M
+MAX_MESSAGE_LENGTH = 20 * 1024 * 1024
+# 只在有请求时发送keepalive ping;tiller(grpc-go)默认拒绝无请求时的ping,
+# 空闲channel持续ping会收到GOAWAY too_many_pings
+CHANNEL_OPTIONS = [
+    ('grpc.keepalive_time_ms', 30000),
+    ('grpc.keepalive_timeout_ms', 10000),
+]
+COMPRESSIONS = {
+    'none': grpc.Compression.NoCompression,
+    'gzip': grpc.Compression.Gzip,
+    'deflate': grpc.Compression.Deflate,
+}
+# 大小报告中列出的最大文件数
+SIZE_REPORT_LARGEST = 5
+
+__all__ = ["Tiller", "CleanupPlan", "CleanupResult", "ChartSizeReport", "SingleFlight", "chart_size_report",
+           "metadata", "get_compression", "check_request_size", "stub", "get_credentials", "get_channel_options", "get_interceptors",
+           "get_channel", "close", "tiller_status", "read", "invalidate_cache", "get_release_content",
+           "get_release_status", "get_release_statuses", "list_releases", "list_releases_request",
+           "iter_releases", "project_release", "list_charts", "update_release",
            "install_release", "rollback_release", "get_history", "test_release",
-           "uninstall_release", "get_version", "chart_cleanup"]
+           "uninstall_release", "get_version", "plan_cleanup", "execute_cleanup",
+           "chart_cleanup"]
+
+
+def _field_tree(fields):
+    '''将("name", "info.status")转换为{"name": {}, "info": {"status": {}}}'''
+    tree = {}
+    for field in fields:
+        node = tree
+        for part in field.split("."):
+            node = node.setdefault(part, {})
+    return tree
+
+
+def _project(message, tree):
+    '''复制message中tree指定的字段,返回新的message
+
+    使用新的message而不是在原message上ClearField,
+    避免投影结果继续持有整个响应的内存.
+    '''
+    result = type(message)()
+    for field, value in message.ListFields():
+        if field.name not in tree:
+            continue
+        subtree = tree[field.name]
+        target = getattr(result, field.name)
+        if field.message_type is None:
+            if field.label == field.LABEL_REPEATED:
+                target.extend(value)
+            else:
+                setattr(result, field.name, value)
+        elif field.label == field.LABEL_REPEATED:
+            for item in value:
+                target.add().CopyFrom(_project(item, subtree) if subtree else item)
+        else:
+            target.CopyFrom(_project(value, subtree) if subtree else value)
+    return result
+
+
+ChartSizeReport = namedtuple('ChartSizeReport', [
+    'name', 'total', 'metadata', 'values', 'templates', 'files',
+    'dependencies', 'largest'])
+ChartSizeReport.__doc__ = '''序列化后的chart大小(字节),dependencies为子chart的ChartSizeReport,
+largest为最大的SIZE_REPORT_LARGEST个模板/文件[(路径, 大小)]'''
+
+
+def chart_size_report(chart, largest=SIZE_REPORT_LARGEST):
+    '''统计hapi.chart.Chart各部分序列化后的大小,用于发送前检查
+    Args:
+        chart: hapi.chart.Chart对象
+        largest: 列出最大的模板/文件个数(int)
+    Returns:
+        ChartSizeReport对象
+    '''
+    items = [(template.name, template.ByteSize()) for template in chart.templates]
+    items.extend((f.type_url, f.ByteSize()) for f in chart.files)
+    return ChartSizeReport(
+        name=chart.metadata.name,
+        total=chart.ByteSize(),
+        metadata=chart.metadata.ByteSize(),
+        values=chart.values.ByteSize(),
+        templates=sum(template.ByteSize() for template in chart.templates),
+        files=sum(f.ByteSize() for f in chart.files),
+        dependencies=tuple(chart_size_report(dependency, largest)
+                           for dependency in chart.dependencies),
+        largest=sorted(items, key=lambda item: item[1], reverse=True)[:largest])
+
+
+class SingleFlight(object):
+    '''
+    合并并发的相同调用:同一个key同时只执行一次fn,
+    其他线程等待并共享结果(或异常)
+    '''
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args, **kwargs):
+        """
+        Args:
+            key: 调用的key,必须可hash
+            fn: 实际执行的函数,参数为args和kwargs
+        Returns:
+            fn的返回值
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+        if not leader:
+            return future.result()
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+CleanupResult = namedtuple('CleanupResult', ['name', 'response', 'error', 'elapsed'])
+CleanupResult.__doc__ = '''单个release的卸载结果,error为None表示卸载成功,elapsed为耗时(秒)'''
+
+
+class CleanupPlan(object):
+    '''
+    chart_cleanup的执行计划,releases为待删除的release名称列表,
+    执行后results保存每个release的CleanupResult
+    '''
+
+    def __init__(self, prefix, releases):
+        self.prefix = prefix
+        self.releases = releases
+        self.results = {}
+
+    @classmethod
+    def build(cls, prefix, charts, actual_releases):
+        """计算需要删除的release
+        Args:
+            :params prefix - release名称前缀
+            :params charts - list of yaml charts
+            :params actual_releases - tiller中已有的release名称列表
+        Returns:
+            CleanupPlan对象
+        """
+        def release_prefix(prefix, chart):
+            """
+            how to attach prefix to chart
+            """
+            return "{}-{}".format(prefix, chart["chart"]["release_name"])
+
+        valid_charts = [release_prefix(prefix, chart) for chart in charts]
+        chart_diff = set(actual_releases) - set(valid_charts)
+        return cls(prefix, sorted(chart for chart in chart_diff
+                                  if chart.startswith(prefix)))
+
+    @property
+    def executed(self):
+        return bool(self.results)
+
+    @property
+    def failed(self):
+        return [result for result in self.results.values()
+                if result.error is not None]
+
+    def __repr__(self):
+        return "<CleanupPlan prefix={} releases={} failed={}>".format(
+            self.prefix, len(self.releases), len(self.failed))
 
 
 class Tiller(object):
@@ -44,7 +231,13 @@ class Tiller(object):
 
     def __init__(self, host, port=44134, ssl_verification=False,
                  root_certificates=None, cert_key=None,
-                 cert_cert=None, ssl_target_name_override='tiller-server'):
+                 cert_cert=None, ssl_target_name_override='tiller-server',
+                 pool_size=CHANNEL_POOL_SIZE, channel_options=None,
+                 compression=None,
+                 max_send_message_length=MAX_MESSAGE_LENGTH,
+                 max_receive_message_length=MAX_MESSAGE_LENGTH, cache=None,
+                 single_flight=False, policy=None, interceptors=None,
+                 metrics=None):
         """Tiller Class 构造函数
         Args:
             host: Tiller host(str)
@@ -54,6 +247,21 @@ class Tiller(object):
             cert_key: 客户端key
             cert_cert: 客户端证书
             ssl_target_name_override: 必须和tiller端证书的common name一致
+            pool_size: channel连接池大小,请求在各channel之间轮询(int) default(1)
+            channel_options: 额外的grpc channel参数,覆盖CHANNEL_OPTIONS中的同名参数(list)
+            compression: install/update请求的压缩算法,可选gzip, deflate或grpc.Compression,
+                         default(None)不压缩,需要tiller端支持对应的解压算法
+            max_send_message_length: 最大发送消息大小,超过时请求不会发送(int) default(20M)
+            max_receive_message_length: 最大接收消息大小(int) default(20M)
+            cache: release内容和历史的缓存(cache.ReleaseCache),为True时使用默认参数创建,
+                   default(None)不缓存
+            single_flight: 是否合并并发的相同读请求(status, content, history, version),
+                           开启后等待同一请求的调用方共享同一个响应对象,不应修改(bool)
+            policy: 超时/重试策略(policy.CallPolicy),为None时使用默认策略:
+                    超时时间为self.timeout,只读请求在UNAVAILABLE等错误时重试
+            interceptors: grpc client interceptor列表,按顺序包装channel
+            metrics: rpc统计(metrics.RpcMetrics),为True时使用默认参数创建,
+                     default(None)不统计
         Returns:
             无返回值
         注意ssl_target_name_override参数,必须和tiller端证书的common name一致,否则会提示无法链接
@@ -66,9 +274,22 @@ class Tiller(object):
         self.cert_key = cert_key
         self.cert_cert = cert_cert
         self.ssl_target_name_override = ssl_target_name_override
-
-        # init tiller channel
-        self.channel = self.get_channel()
+        self.pool_size = max(int(pool_size), 1)
+        self.channel_options = channel_options or []
+        self.compression = self.get_compression(compression)
+        self.max_send_message_length = max_send_message_length
+        self.max_receive_message_length = max_receive_message_length
+        self.cache = ReleaseCache() if cache is True else cache or None
+        self.single_flight = SingleFlight() if single_flight else None
+        self.policy = CallPolicy() if policy is None else policy
+        self.interceptors = list(interceptors or [])
+        self.metrics = RpcMetrics() if metrics is True else metrics or None
+
+        # init tiller channel pool, every channel owns one cached stub
+        self.channels = [self.get_channel() for _ in range(self.pool_size)]
+        self.channel = self.channels[0]
+        self._stubs = [ReleaseServiceStub(channel) for channel in self.channels]
+        self._stub_cycle = itertools.cycle(self._stubs)
 
         # init timeout for all requests
         # and assume eventually this will
@@ -87,6 +308,104 @@ class Tiller(object):
         '''
         return [(b'x-helm-api-client', TILLER_VERSION)]
 
+    @property
+    def stub(self):
+        '''
+        Args:
+            无参数
+        Returns:
+            Return the next cached ReleaseServiceStub of the channel pool(round-robin)
+        '''
+        return next(self._stub_cycle)
+
+    def get_credentials(self):
+        '''
+        Args:
+            无参数
+        Return:
+            Return ssl channel credentials built from the certificate files
+        '''
+        cert_key_file = None
+        cert_cert_file = None
+        with open(self.root_certificates, 'rb') as f:
+            ca_cert_file = f.read()
+        if self.cert_key is not None:
+            with open(self.cert_key, 'rb') as f:
+                cert_key_file = f.read()
+        if self.cert_cert is not None:
+            with open(self.cert_cert, 'rb') as f:
+                cert_cert_file = f.read()
+        return grpc.ssl_channel_credentials(
+            ca_cert_file, cert_key_file, cert_cert_file)
+
+    def get_channel_options(self):
+        '''
+        Args:
+            无参数
+        Return:
+            Return grpc channel options(keepalive, max message size...)
+
+        pool_size大于1时每个channel使用独立的subchannel pool,保证建立独立的http2连接
+        '''
+        options = dict(CHANNEL_OPTIONS)
+        options['grpc.max_send_message_length'] = self.max_send_message_length
+        options['grpc.max_receive_message_length'] = self.max_receive_message_length
+        options.update(dict(self.channel_options))
+        if self.pool_size > 1:
+            options['grpc.use_local_subchannel_pool'] = 1
+        if self.ssl_verification:
+            options['grpc.ssl_target_name_override'] = self.ssl_target_name_override
+        return list(options.items())
+
+    @staticmethod
+    def get_compression(compression):
+        '''
+        Args:
+            compression: 压缩算法名称(none, gzip, deflate),grpc.Compression或None
+        Return:
+            Return grpc.Compression or None
+        '''
+        if compression is None or isinstance(compression, grpc.Compression):
+            return compression
+        try:
+            return COMPRESSIONS[str(compression).lower()]
+        except KeyError:
+            raise CustomError("Unsupported compression {}, choose from {}".format(
+                compression, ", ".join(sorted(COMPRESSIONS))))
+
+    def check_request_size(self, request):
+        '''发送前检查携带chart的请求大小,超过max_send_message_length时抛出CustomError
+        Args:
+            request: InstallReleaseRequest/UpdateReleaseRequest
+        Return:
+            请求序列化后的大小(int)
+        '''
+        size = request.ByteSize()
+        limit = self.max_send_message_length
+        if limit is not None and 0 <= limit < size:
+            report = chart_size_report(request.chart)
+            raise CustomError(
+                "Request of chart {} is {} bytes, exceeds max_send_message_length "
+                "{} bytes (templates {}, files {}, values {}, dependencies {}), "
+                "largest: {}".format(
+                    report.name, size, limit, report.templates, report.files,
+                    report.values, sum(d.total for d in report.dependencies),
+                    ", ".join("{} {}".format(name, n) for name, n in report.largest)))
+        LOG.debug("Request of chart %s is %s bytes", request.chart.metadata.name, size)
+        return size
+
+    def get_interceptors(self):
+        '''
+        Args:
+            无参数
+        Return:
+            Return client interceptors of the channel,开启metrics时统计拦截器位于最外层
+        '''
+        interceptors = list(self.interceptors)
+        if self.metrics is not None:
+            interceptors.insert(0, MetricsInterceptor(self.metrics))
+        return interceptors
+
     def get_channel(self):
         '''
         Args:
@@ -95,23 +414,21 @@ class Tiller(object):
             Return a tiller channel
         '''
         if self.ssl_verification:
-            cert_key_file = None
-            cert_cert_file = None
-            with open(self.root_certificates, 'rb') as f:
-                ca_cert_file = f.read()
-            if self.cert_key is not None:
-                with open(self.cert_key, 'rb') as f:
-                    cert_key_file = f.read()
-            if self.cert_cert is not None:
-                with open(self.cert_cert, 'rb') as f:
-                    cert_cert_file = f.read()
-            creds = grpc.ssl_channel_credentials(
-                ca_cert_file, cert_key_file, cert_cert_file)
-            return grpc.secure_channel(self._host + ":" + self._port, creds,
-                                       options=(('grpc.ssl_target_name_override',
-                                                 self.ssl_target_name_override,),))
+            channel = grpc.secure_channel(self._host + ":" + self._port,
+                                          self.get_credentials(),
+                                          options=self.get_channel_options())
         else:
-            return grpc.insecure_channel('%s:%s' % (self._host, self._port))
+            channel = grpc.insecure_channel('%s:%s' % (self._host, self._port),
+                                            options=self.get_channel_options())
+        interceptors = self.get_interceptors()
+        if interceptors:
+            channel = grpc.intercept_channel(channel, *interceptors)
+        return channel
+
+    def close(self):
+        '''关闭连接池中的所有channel'''
+        for channel in self.channels:
+            channel.close()
 
     def tiller_status(self):
         '''判断__init__中host参数是否已经配置.
@@ -125,17 +442,103 @@ class Tiller(object):
 
         return False
 
-    def get_release_content(self, name):
+    def _call(self, method, request, **kwargs):
+        """按照self.policy发送unary请求
+        每次尝试使用连接池中的下一个stub,所有尝试共享同一个deadline
+        Args:
+            method: ReleaseService的方法名,例如GetReleaseStatus
+            request: 请求对象
+            kwargs: 传递给grpc调用的其他参数,例如compression
+        Returns:
+            grpc响应对象
+        """
+        deadline = self.policy.begin(method, self.timeout)
+        attempt = 0
+        while True:
+            try:
+                return getattr(self.stub, method)(
+                    request, max(deadline - time.monotonic(), 0),
+                    metadata=self.metadata, **kwargs)
+            except grpc.RpcError as e:
+                delay = self.policy.retry_delay(method, e, attempt, deadline)
+                if delay is None:
+                    raise
+                LOG.debug("%s failed: %s, retry in %.3fs", method, e.code(), delay)
+                time.sleep(delay)
+                attempt += 1
+
+    def _stream(self, method, request):
+        """按照self.policy发送response-streaming请求
+        不可重试的方法直接返回grpc的流对象(立即发送请求,可以cancel/code/details);
+        可重试的方法返回生成器,重试时跳过已经返回过的响应
+        """
+        if method not in self.policy.idempotent_methods:
+            deadline = self.policy.begin(method, self.timeout)
+            return getattr(self.stub, method)(
+                request, max(deadline - time.monotonic(), 0), metadata=self.metadata)
+        return self._retry_stream(method, request)
+
+    def _retry_stream(self, method, request):
+        deadline = self.policy.begin(method, self.timeout)
+        attempt = 0
+        received = 0
+        while True:
+            skip = received
+            try:
+                for response in getattr(self.stub, method)(
+                        request, max(deadline - time.monotonic(), 0),
+                        metadata=self.metadata):
+                    if skip:
+                        skip -= 1
+                        continue
+                    received += 1
+                    yield response
+                return
+            except grpc.RpcError as e:
+                delay = self.policy.retry_delay(method, e, attempt, deadline)
+                if delay is None:
+                    raise
+                LOG.debug("%s failed: %s, retry in %.3fs", method, e.code(), delay)
+                time.sleep(delay)
+                attempt += 1
+
+    def read(self, method, request):
+        """发送只读的unary请求,开启single_flight时合并并发的相同请求
+        Args:
+            method: ReleaseService的方法名,例如GetReleaseStatus
+            request: 请求对象
+        Returns:
+            grpc响应对象
+        """
+        if self.single_flight is None:
+            return self._call(method, request)
+        key = (method, request.SerializeToString(deterministic=True))
+        return self.single_flight.do(key, self._call, method, request)
+
+    def invalidate_cache(self, name=None):
+        """删除release缓存,update/rollback/uninstall后自动调用
+        Args:
+            name: release名称,为None时删除所有缓存
+        """
+        if self.cache is not None:
+            self.cache.invalidate(name)
+
+    def get_release_content(self, name, version=0):
         """获得具体release的内容
         Args:
             name: release名称
+            version: release revision,默认0表示最新版本
         Returns:
             Release content
         """
-        stub = ReleaseServiceStub(self.channel)
-        req = GetReleaseContentRequest(name=name)
-        release_content = stub.GetReleaseContent(req, self.timeout,
-                                                 metadata=self.metadata)
+        if self.cache is not None:
+            release_content = self.cache.get_content(name, version)
+            if release_content is not None:
+                return release_content
+        req = GetReleaseContentRequest(name=name, version=version)
+        release_content = self.read('GetReleaseContent', req)
+        if self.cache is not None:
+            self.cache.put_content(name, version, release_content)
         return release_content
 
     def get_release_status(self, name):
@@ -146,13 +549,76 @@ class Tiller(object):
             Release状态
         """
 
-        stub = ReleaseServiceStub(self.channel)
         req = GetReleaseStatusRequest(name=name)
-        release_status = stub.GetReleaseStatus(req, self.timeout,
-                                               metadata=self.metadata)
+        release_status = self.read('GetReleaseStatus', req)
         return release_status
 
-    def list_releases(self, limit=RELEASE_LIMIT, status_codes=[], namespace=None):
+    def get_release_statuses(self, names, max_concurrency=STATUS_CONCURRENCY):
+        """批量获得release的状态
+        使用grpc future并发请求,同时进行中的请求不超过max_concurrency个,
+        可重试的错误按照self.policy退避后以同样的方式重新请求
+        Args:
+            names: release名称列表
+            max_concurrency: 最大并发请求数(int)
+        Returns:
+            {release名称: Release状态}字典,请求失败的release对应的值为异常对象(grpc.RpcError)
+        """
+        semaphore = threading.BoundedSemaphore(max(int(max_concurrency), 1))
+
+        def submit(name, deadline=None):
+            semaphore.acquire()
+            # 第一次请求的deadline从获得信号量后开始计算,排队时间不计入超时
+            if deadline is None:
+                deadline = self.policy.begin('GetReleaseStatus', self.timeout)
+            req = GetReleaseStatusRequest(name=name)
+            try:
+                future = self.stub.GetReleaseStatus.future(
+                    req, max(deadline - time.monotonic(), 0), metadata=self.metadata)
+            except Exception:
+                semaphore.release()
+                raise
+            future.add_done_callback(lambda _: semaphore.release())
+            return future, deadline
+
+        names = list(dict.fromkeys(names))
+        pending = dict((name, submit(name)) for name in names)
+        statuses = {}
+        attempt = 0
+        while pending:
+            failed = {}
+            for name, (future, deadline) in pending.items():
+                try:
+                    statuses[name] = future.result()
+                except grpc.RpcError as e:
+                    if attempt + 1 < self.policy.max_attempts and \
+                            self.policy.retryable('GetReleaseStatus', e):
+                        failed[name] = (e, deadline)
+                    else:
+                        LOG.debug("Get status of release %s failed: %s", name, e)
+                        statuses[name] = e
+                except grpc.FutureCancelledError as e:
+                    LOG.debug("Get status of release %s failed: %s", name, e)
+                    statuses[name] = e
+
+            # 可重试的错误在退避之后重新并发请求,每个重试请求消耗一个重试预算
+            delay = self.policy.backoff(attempt) if failed else 0
+            retries = []
+            for name, (e, deadline) in failed.items():
+                if time.monotonic() + delay < deadline and self.policy.budget.withdraw():
+                    retries.append((name, deadline))
+                else:
+                    LOG.debug("Get status of release %s failed: %s", name, e)
+                    statuses[name] = e
+            if retries:
+                LOG.debug("GetReleaseStatus of %d releases failed, retry in %.3fs",
+                          len(retries), delay)
+                time.sleep(delay)
+            pending = dict((name, submit(name, deadline)) for name, deadline in retries)
+            attempt += 1
+        return dict((name, statuses[name]) for name in names)
+
+    def list_releases(self, limit=RELEASE_LIMIT, status_codes=[], namespace=None,
+                      fields=None):
         '''获得release列表
         Argss:
             :params limit - number of result
@@ -161,29 +627,103 @@ class Tiller(object):
                        DELETING, PENDING_INSTALL, PENDING_UPGRADE,
                        PENDING_ROLLBACK)
             :params namespace(srt) - k8s namespace
+            :params fields - 只保留的release字段,例如("name", "version", "info.status"),
+                             为None时返回完整的release
         Returns:
             List Helm Releases
         '''
         releases = []
-        stub = ReleaseServiceStub(self.channel)
         req = ListReleasesRequest(
             limit=limit, status_codes=status_codes, namespace=namespace or '')
-        release_list = stub.ListReleases(req, self.timeout,
-                                         metadata=self.metadata)
+        release_list = self._stream('ListReleases', req)
         for y in release_list:
-            releases.extend(y.releases)
+            if fields is None:
+                releases.extend(y.releases)
+            else:
+                releases.extend(self.project_release(release, fields)
+                                for release in y.releases)
         return releases
 
-    def list_charts(self):
+    @staticmethod
+    def project_release(release, fields):
+        '''投影release,只保留fields中的字段,丢弃chart模板/manifest等大字段
+        Args:
+            :params release - Release对象
+            :params fields - 字段列表,支持"info.status"形式的嵌套字段
+        Returns:
+            只包含fields字段的新Release对象
+        '''
+        return _project(release, _field_tree(fields))
+
+    @staticmethod
+    def list_releases_request(limit=RELEASE_LIMIT, offset='', status_codes=[],
+                              namespace=None, sort_by='NAME', sort_order='ASC',
+                              filter=''):
+        '''生成ListReleasesRequest
+        Args:
+            :params limit - number of result
+            :params offset - 分页起始release名称,即上一页响应中的next
+            :params status_codes - status_codes list used for filter
+            :params namespace(str) - k8s namespace
+            :params sort_by - 排序字段(UNKNOWN, NAME, LAST_RELEASED)
+            :params sort_order - 排序方式(ASC, DESC)
+            :params filter(str) - release名称正则过滤
+        Returns:
+            ListReleasesRequest对象
+        '''
+        if isinstance(sort_by, str):
+            sort_by = ListSort.SortBy.Value(sort_by.upper())
+        if isinstance(sort_order, str):
+            sort_order = ListSort.SortOrder.Value(sort_order.upper())
+        return ListReleasesRequest(limit=limit, offset=offset,
+                                   status_codes=status_codes,
+                                   namespace=namespace or '',
+                                   sort_by=sort_by, sort_order=sort_order,
+                                   filter=filter)
+
+    def iter_releases(self, page_size=LIST_PAGE_SIZE, status_codes=[],
+                      namespace=None, sort_by='NAME', sort_order='ASC',
+                      filter='', fields=None):
+        '''分页获取release,逐个返回
+        每次只请求page_size个release,根据响应中的next继续请求下一页,
+        内存占用与集群中release总数无关.
+        Args:
+            :params page_size - 每页release数量
+            :params status_codes - status_codes list used for filter
+            :params namespace(str) - k8s namespace
+            :params sort_by - 排序字段(UNKNOWN, NAME, LAST_RELEASED)
+            :params sort_order - 排序方式(ASC, DESC)
+            :params filter(str) - release名称正则过滤
+            :params fields - 只保留的release字段,为None时返回完整的release
+        Returns:
+            generator of Helm Releases
+        '''
+        tree = _field_tree(fields) if fields is not None else None
+        offset = ''
+        while True:
+            req = self.list_releases_request(
+                limit=page_size, offset=offset, status_codes=status_codes,
+                namespace=namespace, sort_by=sort_by, sort_order=sort_order,
+                filter=filter)
+            offset = ''
+            for y in self._stream('ListReleases', req):
+                offset = y.next or offset
+                for release in y.releases:
+                    yield release if tree is None else _project(release, tree)
+            if not offset:
+                break
+
+    def list_charts(self, fields=None):
         '''
         List Helm Charts from Latest Releases
         Args:
-            无参数
+            fields: 只保留的release字段,例如RELEASE_SUMMARY_FIELDS,
+                    未包含的chart/values将为空
         Return:
             list of (name, version, chart, values)
         '''
         charts = []
-        for latest_release in self.list_releases():
+        for latest_release in self.list_releases(fields=fields):
             try:
                 charts.append((latest_release.name, latest_release.version,
                                latest_release.chart,
@@ -195,7 +735,7 @@ class Tiller(object):
     def update_release(self, chart, name, dry_run=False,
                        disable_hooks=False, values=None, recreate=False,
                        reset_values=False, reuse_values=False, force=False,
-                       timeout=REQUEST_TIMEOUT):
+                       timeout=REQUEST_TIMEOUT, compression=None):
         """升级release
         Args:
             :params - chart - chart 元数据,由函数生成
@@ -207,6 +747,7 @@ class Tiller(object):
             :params - reset_values - when upgrading, reset the values to the ones built into the chart(bool)
             :params - reuse_values - when upgrading, reuse the last release's values and merge in any overrides from the command line via --set and -f. If '--reset-values' is specified, this is ignored.(bool)
             :params - force - 是否强制升级(bool)
+            :params - compression - 本次请求的压缩算法,为None时使用Tiller的compression
         Returns:
             返回升级release的grpc响应对象
         """
@@ -214,7 +755,6 @@ class Tiller(object):
         values = Config(raw=yaml.safe_dump(values or {}))
 
         # build update release request
-        stub = ReleaseServiceStub(self.channel)
         release_request = UpdateReleaseRequest(
             chart=chart,
             dry_run=dry_run,
@@ -226,14 +766,20 @@ class Tiller(object):
             values=values,
             timeout=timeout,
             name=name)
+        self.check_request_size(release_request)
 
-        return stub.UpdateRelease(release_request, self.timeout,
-                                  metadata=self.metadata)
+        try:
+            return self._call('UpdateRelease', release_request,
+                              compression=self.compression if compression is None
+                              else self.get_compression(compression))
+        finally:
+            if not dry_run:
+                self.invalidate_cache(name)
 
     def install_release(self, chart, namespace, disable_hooks=False,
                         reuse_name=False, disable_crd_hook=False,
                         timeout=REQUEST_TIMEOUT, dry_run=False,
-                        name=None, values=None):
+                        name=None, values=None, compression=None):
         """安装release
         Args:
             :params - chart - chart 元数据,由函数生成
@@ -245,6 +791,7 @@ class Tiller(object):
             :params - disable_crd_hook - prevent CRD hooks from running, but run other hooks(bool)
             :params - reuse_name - re-use the given name, even if that name is already used. This is unsafe in production(bool)
             :params - timeout - time in seconds to wait for any individual Kubernetes operation (like Jobs for hooks) (default 300)
+            :params - compression - 本次请求的压缩算法,为None时使用Tiller的compression
         Returns:
             返回安装release的grpc响应对象
         """
@@ -252,7 +799,6 @@ class Tiller(object):
         #values = Config(raw=yaml.safe_dump(values or {}))
 
         # build release install request
-        stub = ReleaseServiceStub(self.channel)
         release_request = InstallReleaseRequest(
             chart=chart,
             disable_hooks=disable_hooks,
@@ -263,9 +809,14 @@ class Tiller(object):
             values=values,
             name=name or '',
             namespace=namespace)
-        return stub.InstallRelease(release_request,
-                                   self.timeout,
-                                   metadata=self.metadata)
+        self.check_request_size(release_request)
+        try:
+            return self._call('InstallRelease', release_request,
+                              compression=self.compression if compression is None
+                              else self.get_compression(compression))
+        finally:
+            if name and not dry_run:
+                self.invalidate_cache(name)
 
     def rollback_release(self, name, version, timeout=REQUEST_TIMEOUT,
                          dry_run=False, disable_hooks=False,
@@ -281,7 +832,6 @@ class Tiller(object):
             返回回滚release的grpc响应对象
         """
         # build rollback release request
-        stub = ReleaseServiceStub(self.channel)
         rollback_release_request = RollbackReleaseRequest(
             name=name,
             timeout=timeout,
@@ -291,9 +841,11 @@ class Tiller(object):
             recreate=recreate,
             wait=wait,
             force=force)
-        return stub.RollbackRelease(rollback_release_request,
-                                    self.timeout,
-                                    metadata=self.metadata)
+        try:
+            return self._call('RollbackRelease', rollback_release_request)
+        finally:
+            if not dry_run:
+                self.invalidate_cache(name)
 
     def get_history(self, name, max=MAX_HISTORY):
         """usage: ReleaseHistory retrieves a releasse's history
@@ -304,13 +856,17 @@ class Tiller(object):
             返回版本的历史的grpc响应对象
 
         """
+        if self.cache is not None:
+            history = self.cache.get_history(name, max)
+            if history is not None:
+                return history
         # build get history request
-        stub = ReleaseServiceStub(self.channel)
         get_history_request = GetHistoryRequest(name=name,
                                                 max=max)
-        return stub.GetHistory(get_history_request,
-                               self.timeout,
-                               metadata=self.metadata)
+        history = self.read('GetHistory', get_history_request)
+        if self.cache is not None:
+            self.cache.put_history(name, max, history)
+        return history
 
     def test_release(self, name, cleanup=False, timeout=REQUEST_TIMEOUT):
         """usage: RunReleaseTest executes the tests defined of a named release
@@ -321,12 +877,9 @@ class Tiller(object):
             返回测试安装的grpc响应对象
         """
         # build  releaseTest request
-        stub = ReleaseServiceStub(self.channel)
         test_release_request = TestReleaseRequest(name=name,
                                                   cleanup=cleanup)
-        return stub.RunReleaseTest(test_release_request,
-                                   self.timeout,
-                                   metadata=self.metadata)
+        return self._stream('RunReleaseTest', test_release_request)
 
     def uninstall_release(self, release, timeout=REQUEST_TIMEOUT,
                           disable_hooks=False, purge=False):
@@ -339,14 +892,14 @@ class Tiller(object):
         """
 
         # build release install request
-        stub = ReleaseServiceStub(self.channel)
         release_request = UninstallReleaseRequest(name=release,
                                                   timeout=timeout,
                                                   disable_hooks=disable_hooks,
                                                   purge=purge)
-        return stub.UninstallRelease(release_request,
-                                     self.timeout,
-                                     metadata=self.metadata)
+        try:
+            return self._call('UninstallRelease', release_request)
+        finally:
+            self.invalidate_cache(release)
 
     def get_version(self):
         """GetVersion returns the current version of the server
@@ -356,33 +909,59 @@ class Tiller(object):
             返回tiller的版本grpc响应对象
         """
         # build get version request
-        stub = ReleaseServiceStub(self.channel)
         get_version_request = GetVersionRequest()
-        return stub.GetVersion(get_version_request,
-                               self.timeout,
-                               metadata=self.metadata)
+        return self.read('GetVersion', get_version_request)
 
-    def chart_cleanup(self, prefix, charts):
-        """
+    def plan_cleanup(self, prefix, charts):
+        """计算chart_cleanup需要删除的release,不做任何修改
+        :params prefix - release名称前缀
         :params charts - list of yaml charts
-        :params known_release - list of releases in tiller
 
-        :result - will remove any chart that is not present in yaml
+        :result - CleanupPlan对象
         """
-        def release_prefix(prefix, chart):
-            """
-            how to attach prefix to chart
-            """
-            return "{}-{}".format(prefix, chart["chart"]["release_name"])
+        actual_charts = [x.name for x in self.iter_releases(fields=("name",))]
+        return CleanupPlan.build(prefix, charts, actual_charts)
 
-        valid_charts = [release_prefix(prefix, chart) for chart in charts]
-        actual_charts = [x.name for x in self.list_releases()]
-        chart_diff = list(set(actual_charts) - set(valid_charts))
+    def execute_cleanup(self, plan, workers=CLEANUP_WORKERS, **kwargs):
+        """并发卸载plan中的release
+        :params plan - CleanupPlan对象
+        :params workers - 并发卸载的线程数
+        :params kwargs - 传递给uninstall_release的参数(timeout, disable_hooks, purge)
 
-        for chart in chart_diff:
-            if chart.startswith(prefix):
-                LOG.debug("Release: %s will be removed", chart)
-                self.uninstall_release(chart)
+        :result - plan对象,plan.results记录每个release的卸载结果与耗时
+        """
+        def uninstall(chart):
+            LOG.debug("Release: %s will be removed", chart)
+            start = time.time()
+            try:
+                response = self.uninstall_release(chart, **kwargs)
+            except Exception as e:
+                LOG.error("Remove release %s failed: %s", chart, e)
+                return CleanupResult(chart, None, e, time.time() - start)
+            return CleanupResult(chart, response, None, time.time() - start)
+
+        if not plan.releases:
+            return plan
+        with ThreadPoolExecutor(max_workers=max(min(int(workers), len(plan.releases)), 1)) as executor:
+            for result in executor.map(uninstall, plan.releases):
+                plan.results[result.name] = result
+        return plan
+
+    def chart_cleanup(self, prefix, charts, dry_run=False,
+                      workers=CLEANUP_WORKERS, **kwargs):
+        """
+        :params charts - list of yaml charts
+        :params dry_run - 只计算需要删除的release,不执行卸载
+        :params workers - 并发卸载的线程数
+        :params kwargs - 传递给uninstall_release的参数(timeout, disable_hooks, purge)
+
+        :result - will remove any chart that is not present in yaml,
+                  返回CleanupPlan对象
+        """
+        plan = self.plan_cleanup(prefix, charts)
+        if dry_run:
+            return plan
+        return self.execute_cleanup(plan, workers=workers, **kwargs)
 
 
 if __name__ == "__main__":
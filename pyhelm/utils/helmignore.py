@@ -0,0 +1,141 @@
+#coding:utf-8
+"""
+helmignore 解析.helmignore并判断文件是否需要忽略
+
+规则与helm(pkg/ignore)一致:
+    1. 每行一个shell glob规则,#开头为注释
+    2. 以/结尾的规则只匹配目录
+    3. 以!开头的规则表示不忽略
+    4. 以/开头或包含/的规则匹配相对路径,否则只匹配文件名
+    5. 按顺序匹配,第一条匹配的规则生效
+"""
+import re
+from functools import lru_cache
+
+from utils.exceptions import CustomError
+
+__all__ = ["HelmIgnore", "DEFAULT_RULES", "load", "parse", "ignored", "ignored_file"]
+
+# helm默认忽略templates下的隐藏文件
+DEFAULT_RULES = ["templates/.?*"]
+
+
+def _translate(pattern):
+    """translate a filepath.Match pattern into regex, * and ? never match /"""
+    i, n = 0, len(pattern)
+    result = []
+    while i < n:
+        c = pattern[i]
+        i += 1
+        if c == '*':
+            result.append('[^/]*')
+        elif c == '?':
+            result.append('[^/]')
+        elif c == '\\' and i < n:
+            result.append(re.escape(pattern[i]))
+            i += 1
+        elif c == '[':
+            j = i
+            if j < n and pattern[j] in '!^':
+                j += 1
+            if j < n and pattern[j] == ']':
+                j += 1
+            while j < n and pattern[j] != ']':
+                j += 1
+            if j >= n:
+                raise CustomError("Invalid .helmignore pattern {}".format(pattern))
+            chars = pattern[i:j].replace('\\', '\\\\')
+            if chars[:1] in ('!', '^'):
+                chars = '^' + chars[1:]
+            result.append('(?!/)[' + chars + ']')
+            i = j + 1
+        else:
+            result.append(re.escape(c))
+    return '^' + ''.join(result) + '$'
+
+
+class HelmIgnore(object):
+    """Compiled .helmignore rules"""
+
+    __slots__ = ('rules',)
+
+    def __init__(self, lines=(), defaults=True):
+        """
+        Args:
+            lines: 规则列表
+            defaults: 是否添加DEFAULT_RULES
+        """
+        self.rules = []
+        for line in list(lines) + (DEFAULT_RULES if defaults else []):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if '**' in line:
+                raise CustomError("Rule {} has unsupported '**'".format(line))
+            negate = line.startswith('!')
+            if negate:
+                line = line[1:]
+            must_dir = line.endswith('/')
+            if must_dir:
+                line = line.rstrip('/')
+            basename = '/' not in line
+            regex = re.compile(_translate(line.lstrip('/')))
+            self.rules.append((regex.match, negate, must_dir, basename))
+
+    @classmethod
+    def parse(cls, content, defaults=True):
+        """
+        Args:
+            content: .helmignore内容(bytes/str)
+            defaults: 是否添加DEFAULT_RULES
+        Returns:
+            HelmIgnore对象
+        """
+        if isinstance(content, bytes):
+            content = content.decode('utf-8')
+        return cls(content.splitlines(), defaults=defaults)
+
+    def ignored(self, path, is_dir=False):
+        """
+        Args:
+            path: 相对于chart根目录的路径,使用/分隔
+            is_dir: 是否为目录
+        Returns:
+            是否忽略(bool)
+        """
+        if path in ('', '.', './'):
+            return False
+        name = path.rsplit('/', 1)[-1]
+        for match, negate, must_dir, basename in self.rules:
+            if must_dir and not is_dir:
+                continue
+            if match(name if basename else path):
+                return not negate
+        return False
+
+    def ignored_file(self, path):
+        """
+        压缩包等没有目录结构的场景,依次检查文件的各级父目录和文件本身
+        Args:
+            path: 相对于chart根目录的文件路径,使用/分隔
+        Returns:
+            是否忽略(bool)
+        """
+        parts = path.split('/')
+        for i in range(1, len(parts)):
+            if self.ignored('/'.join(parts[:i]), is_dir=True):
+                return True
+        return self.ignored(path)
+
+
+@lru_cache(maxsize=256)
+def load(content=b""):
+    """return compiled HelmIgnore of .helmignore content,相同内容只编译一次
+
+    Args:
+        content: .helmignore内容(bytes/str),为空时只使用默认规则
+
+    Returns:
+        HelmIgnore对象
+    """
+    return HelmIgnore.parse(content or b"")
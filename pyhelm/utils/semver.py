@@ -0,0 +1,254 @@
+#coding:utf-8
+"""
+semver 语义化版本解析以及版本约束匹配
+
+约束语法与helm(Masterminds/semver)一致:
+    1.2.3, =1.2.3, !=1.2.3, >1.2, >=1.2, <2.0, <=2.0
+    ~1.2.3(>=1.2.3 <1.3.0), ^1.2.3(>=1.2.3 <2.0.0)
+    1.2.x, 1.x, *(任意版本), 1.2 - 1.4.5(范围)
+    空格或逗号表示且, ||表示或, latest表示最新的正式版本
+"""
+import bisect
+import re
+from functools import lru_cache
+
+from utils.exceptions import CustomError
+
+__all__ = ["parse_version", "parse_constraint", "VersionIndex"]
+
+_VERSION_RE = re.compile(
+    r'^v?(\d+|[xX*])(?:\.(\d+|[xX*]))?(?:\.(\d+|[xX*]))?'
+    r'(?:-([0-9A-Za-z.-]+))?(?:\+[0-9A-Za-z.-]+)?$')
+_COMPARATOR_RE = re.compile(r'^(!=|>=|<=|=>|=<|~>|>|<|=|~|\^)?\s*(\S+)$')
+_WILDCARDS = ('x', 'X', '*')
+# 正式版本的prerelease部分排在所有预发布版本之后
+_RELEASE = (1,)
+
+
+def _prerelease_key(prerelease):
+    if not prerelease:
+        return _RELEASE
+    parts = []
+    for part in prerelease.split('.'):
+        if part.isdigit():
+            parts.append((0, int(part), ''))
+        else:
+            parts.append((1, 0, part))
+    return (0,) + tuple(parts)
+
+
+def _parse(version):
+    """return ([major, minor, patch], prerelease) with None for wildcard parts"""
+    match = _VERSION_RE.match(str(version).strip())
+    if match is None:
+        return None
+    parts = []
+    for part in match.group(1, 2, 3):
+        parts.append(None if part is None or part in _WILDCARDS else int(part))
+    # 1.x.3 视为 1.x
+    for i in range(1, 3):
+        if parts[i - 1] is None:
+            parts[i] = None
+    return parts, match.group(4)
+
+
+@lru_cache(maxsize=4096)
+def parse_version(version):
+    """parse version string to sortable key
+
+    Args:
+        version: 版本字符串,例如1.2.3-rc.1(str)
+
+    Returns:
+        可比较的版本tuple,无法解析时返回None
+    """
+    parsed = _parse(version)
+    if parsed is None or None in parsed[0]:
+        return None
+    (major, minor, patch), prerelease = parsed
+    return (major, minor, patch, _prerelease_key(prerelease))
+
+
+def _key(major, minor, patch):
+    return (major, minor, patch, _RELEASE)
+
+
+def _bump(parts):
+    """return the first version after all versions matching the wildcard parts"""
+    major, minor, _ = parts
+    if major is None:
+        return None
+    if minor is None:
+        return _key(major + 1, 0, 0)
+    return _key(major, minor + 1, 0)
+
+
+def _comparator(op, version):
+    """return (lower, lower_inclusive, upper, upper_inclusive, excluded)"""
+    parsed = _parse(version)
+    if parsed is None:
+        raise CustomError("Invalid version constraint {}{}".format(op, version))
+    parts, prerelease = parsed
+    wildcard = None in parts
+    base = tuple(p or 0 for p in parts)
+    key = base + (_prerelease_key(prerelease),)
+    op = {'=>': '>=', '=<': '<=', '~>': '~'}.get(op, op or '=')
+
+    if parts[0] is None:
+        # *, x
+        return None, True, None, False, None
+    if op == '=':
+        if wildcard:
+            return key, True, _bump(parts), False, None
+        return key, True, key, True, None
+    if op == '!=':
+        if wildcard:
+            raise CustomError("Wildcard is not supported by != ({})".format(version))
+        return None, True, None, False, key
+    if op == '>':
+        if wildcard:
+            return _bump(parts), True, None, False, None
+        return key, False, None, False, None
+    if op == '>=':
+        return key, True, None, False, None
+    if op == '<':
+        return None, True, key, False, None
+    if op == '<=':
+        if wildcard:
+            return None, True, _bump(parts), False, None
+        return None, True, key, True, None
+    if op == '~':
+        major, minor, _ = base
+        if parts[1] is None:
+            return key, True, _key(major + 1, 0, 0), False, None
+        return key, True, _key(major, minor + 1, 0), False, None
+    if op == '^':
+        major, minor, patch = base
+        if major > 0 or parts[1] is None:
+            upper = _key(major + 1, 0, 0)
+        elif minor > 0 or parts[2] is None:
+            upper = _key(0, minor + 1, 0)
+        else:
+            upper = _key(0, 0, patch + 1)
+        return key, True, upper, False, None
+    raise CustomError("Unknown constraint operator {}".format(op))
+
+
+def _tokens(expression):
+    """split an and-expression into (op, version) comparators"""
+    expression = re.sub(r'(!=|>=|<=|=>|=<|~>|>|<|=|~|\^)\s+', r'\1', expression)
+    hyphen = re.match(r'^(\S+)\s+-\s+(\S+)$', expression)
+    if hyphen:
+        return [('>=', hyphen.group(1)), ('<=', hyphen.group(2))]
+    result = []
+    for item in re.split(r'[\s,]+', expression):
+        if not item:
+            continue
+        match = _COMPARATOR_RE.match(item)
+        if match is None:
+            raise CustomError("Invalid version constraint {}".format(item))
+        result.append((match.group(1) or '', match.group(2)))
+    return result
+
+
+@lru_cache(maxsize=1024)
+def parse_constraint(constraint):
+    """parse constraint string
+
+    Args:
+        constraint: 版本约束字符串(str)
+
+    Returns:
+        由(lower, lower_inclusive, upper, upper_inclusive, excluded, prerelease)
+        组成的tuple,多个元素之间为"或"的关系
+    """
+    ranges = []
+    for expression in str(constraint).split('||'):
+        lower, lower_inclusive, upper, upper_inclusive = None, True, None, False
+        excluded = []
+        prerelease = False
+        for op, version in _tokens(expression.strip()):
+            lo, lo_inc, hi, hi_inc, ex = _comparator(op, version)
+            prerelease = prerelease or '-' in version.split('+')[0]
+            if lo is not None and (lower is None or lo > lower or
+                                   (lo == lower and not lo_inc)):
+                lower, lower_inclusive = lo, lo_inc
+            if hi is not None and (upper is None or hi < upper or
+                                   (hi == upper and not hi_inc)):
+                upper, upper_inclusive = hi, hi_inc
+            if ex is not None:
+                excluded.append(ex)
+        ranges.append((lower, lower_inclusive, upper, upper_inclusive,
+                       frozenset(excluded), prerelease))
+    return tuple(ranges)
+
+
+class VersionIndex(object):
+    """Sorted semver index of one chart's versions
+
+    查询满足约束的最高版本,复杂度O(log n)
+    """
+    __slots__ = ('_keys', '_items', '_exact')
+
+    def __init__(self, items, version=lambda item: item.version):
+        """
+        Args:
+            items: 版本条目列表
+            version: 从条目中获取版本字符串的函数
+        """
+        parsed = []
+        self._exact = {}
+        for item in items:
+            self._exact.setdefault(str(version(item)), item)
+            key = parse_version(version(item))
+            if key is not None:
+                parsed.append((key, item))
+        parsed.sort(key=lambda x: x[0])
+        self._keys = [key for key, _ in parsed]
+        self._items = [item for _, item in parsed]
+
+    def latest(self, prerelease=False):
+        """return the highest version, skip prerelease unless prerelease=True"""
+        for i in range(len(self._keys) - 1, -1, -1):
+            if prerelease or self._keys[i][3] == _RELEASE:
+                return self._items[i]
+        return None
+
+    def query(self, constraint=None):
+        """return the highest version matching constraint
+
+        Args:
+            constraint: 版本约束(str),None/""/latest表示最新正式版本
+
+        Returns:
+            满足约束的版本条目,没有满足的版本时返回None
+        """
+        if constraint is None or str(constraint).strip() in ('', 'latest'):
+            return self.latest() or self.latest(prerelease=True)
+        constraint = str(constraint).strip()
+        if constraint in self._exact:
+            return self._exact[constraint]
+
+        best = None
+        for lower, lower_inc, upper, upper_inc, excluded, prerelease in \
+                parse_constraint(constraint):
+            if upper is None:
+                hi = len(self._keys)
+            elif upper_inc:
+                hi = bisect.bisect_right(self._keys, upper)
+            else:
+                hi = bisect.bisect_left(self._keys, upper)
+            if lower is None:
+                lo = 0
+            elif lower_inc:
+                lo = bisect.bisect_left(self._keys, lower)
+            else:
+                lo = bisect.bisect_right(self._keys, lower)
+            for i in range(hi - 1, lo - 1, -1):
+                key = self._keys[i]
+                if key in excluded or (not prerelease and key[3] != _RELEASE):
+                    continue
+                if best is None or key > best[0]:
+                    best = (key, self._items[i])
+                break
+        return best[1] if best is not None else None
@@ -0,0 +1,367 @@
+#-*- coding:utf-8 -*-
+"""
+values 合并--set风格的values覆盖项
+
+所有覆盖项先按路径插入同一棵前缀树,再与基础values单次合并:
+    1. key支持a.b.c, a.b[0].c, 转义的a\\.b(key中包含.)
+    2. 同一路径后设置的值覆盖先设置的值
+    3. 覆盖项的值为None(null)时删除基础values中的key
+    4. 合并时只复制被覆盖的路径,不修改基础values
+
+compile_set解析helm --set/--set-string/--set-file表达式:
+    a=1,b.c[0]=x,d={x,y},e=a\\,b
+编译结果按表达式字符串缓存,可以重复应用到多个release
+"""
+from functools import lru_cache
+
+from utils.exceptions import CustomError
+
+__all__ = ["ValuesTrie", "Setter", "parse_path", "typed_value", "merge_values",
+           "compile_set", "set", "update", "merge", "apply"]
+
+SET_KINDS = ('set', 'string', 'file')
+
+_MISSING = object()
+_DELETE = object()
+
+
+@lru_cache(maxsize=4096)
+def parse_path(key):
+    """parse --set style key to path tuple
+
+    Args:
+        key: 例如a.b[0].c, a\\.b.c(str),空字符串或.表示根节点
+
+    Returns:
+        由str(map key)和int(list下标)组成的tuple,例如('a', 'b', 0, 'c')
+    """
+    if key in ('', '.'):
+        return ()
+    parts = []
+    buf = []
+    # 上一个字符是.(需要一个key)或]
+    expect_key, after_index = True, False
+    i, n = 0, len(key)
+    while i < n:
+        c = key[i]
+        if after_index and c not in '.[':
+            raise CustomError("Invalid key {}: unexpected {!r} after ]".format(key, c))
+        if c == '\\' and i + 1 < n:
+            buf.append(key[i + 1])
+            expect_key = False
+            i += 2
+            continue
+        if c == '.':
+            if buf:
+                parts.append(''.join(buf))
+                buf = []
+            elif expect_key:
+                raise CustomError("Invalid key {}: empty key".format(key))
+            expect_key, after_index = True, False
+        elif c == '[':
+            if buf:
+                parts.append(''.join(buf))
+                buf = []
+            elif not parts or expect_key and not after_index:
+                raise CustomError("Invalid key {}: index without key".format(key))
+            end = key.find(']', i)
+            index = key[i + 1:end] if end > 0 else ''
+            if not index.isdigit():
+                raise CustomError("Invalid key {}: bad list index".format(key))
+            parts.append(int(index))
+            expect_key, after_index = False, True
+            i = end
+        else:
+            buf.append(c)
+            expect_key = False
+        i += 1
+    if buf:
+        parts.append(''.join(buf))
+    elif expect_key:
+        raise CustomError("Invalid key {}: empty key".format(key))
+    return tuple(parts)
+
+
+def typed_value(value):
+    """helm --set的类型转换
+
+    true/false转换为bool,null转换为None,不以0开头的整数转换为int,
+    其他值(包括0123这类以0开头的字符串)保持为str
+
+    Args:
+        value: --set的值(str),非str的值原样返回
+    """
+    if not isinstance(value, str):
+        return value
+    lower = value.lower()
+    if lower == 'true':
+        return True
+    if lower == 'false':
+        return False
+    if lower == 'null':
+        return None
+    if value == '0':
+        return 0
+    if value and value[0] != '0':
+        try:
+            number = int(value)
+        except ValueError:
+            return value
+        # int()接受的1_000和空白等写法helm不接受
+        if str(number) == value.lstrip('+'):
+            return number
+    return value
+
+
+class _Node(object):
+    """trie node, index为True时children的key是list下标,否则是map key
+
+    只有parse_path解析出的路径可以产生list下标,dict值中的int key仍然是map key
+    """
+    __slots__ = ('children', 'value', 'leaf', 'index')
+
+    def __init__(self):
+        self.children = {}
+        self.value = None
+        self.leaf = False
+        self.index = False
+
+    def child(self, part, index=False):
+        if self.leaf:
+            self.leaf, self.value = False, None
+        if self.children and self.index != index:
+            # map与list之间切换,以后设置的为准
+            self.children = {}
+        self.index = index
+        node = self.children.get(part)
+        if node is None:
+            node = self.children[part] = _Node()
+        return node
+
+    def assign(self, value):
+        if isinstance(value, dict):
+            # dict按key逐个合并,与coalesceTables行为一致
+            if self.leaf:
+                self.leaf, self.value = False, None
+            for key, val in value.items():
+                self.child(key).assign(val)
+        else:
+            self.leaf, self.value, self.children = True, value, {}
+
+    def is_list(self):
+        return self.index and bool(self.children)
+
+
+def _merge(current, node):
+    """merge node into current, only copy containers on the touched path"""
+    if node.leaf:
+        return _DELETE if node.value is None else node.value
+    if node.is_list():
+        result = list(current) if isinstance(current, list) else []
+        for index, child in node.children.items():
+            if index >= len(result):
+                result.extend([None] * (index + 1 - len(result)))
+            value = _merge(result[index], child)
+            result[index] = None if value is _DELETE else value
+        return result
+    result = dict(current) if isinstance(current, dict) else {}
+    for key, child in node.children.items():
+        value = _merge(result.get(key, _MISSING), child)
+        if value is _DELETE:
+            result.pop(key, None)
+        else:
+            result[key] = value
+    return result
+
+
+class ValuesTrie(object):
+    """
+    Prefix tree of values overrides
+
+        trie = ValuesTrie()
+        trie.set('image.tag', '1.0')
+        trie.set('env[0].name', 'DEBUG')
+        trie.merge({'image': {'repository': 'nginx'}})
+    """
+    __slots__ = ('root',)
+
+    def __init__(self, values=None):
+        """
+        Args:
+            values: {key: value}覆盖项字典,key的格式见parse_path
+        """
+        self.root = _Node()
+        if values:
+            self.update(values)
+
+    def set(self, key, value, typed=False):
+        """
+        设置一个覆盖项
+        Args:
+            key: 路径字符串或parse_path返回的tuple
+            value: 值,dict会按key合并,None表示删除
+            typed: 是否对str类型的值做helm --set的类型转换(bool)
+        """
+        path = parse_path(key) if isinstance(key, str) else tuple(key)
+        if typed:
+            value = typed_value(value)
+        if not path and not isinstance(value, dict) and value is not None:
+            raise CustomError("Values root must be a map, got {!r}".format(value))
+        node = self.root
+        for part in path:
+            node = node.child(part, isinstance(part, int))
+        node.assign(value)
+
+    def update(self, values, typed=False):
+        """按顺序设置values字典中的所有覆盖项,参数同set"""
+        for key, value in values.items():
+            self.set(key, value, typed=typed)
+
+    def merge(self, base=None):
+        """
+        将覆盖项合并到base中,base不会被修改
+        Args:
+            base: 基础values(dict)
+        Returns:
+            合并后的values(dict)
+        """
+        result = _merge({} if base is None else base, self.root)
+        return {} if result is _DELETE else result
+
+
+def merge_values(base, values, typed=False):
+    """
+    Args:
+        base: 基础values(dict)
+        values: {key: value}覆盖项字典
+        typed: 是否对str类型的值做helm --set的类型转换(bool)
+    Returns:
+        合并后的values(dict)
+    """
+    trie = ValuesTrie()
+    trie.update(values or {}, typed=typed)
+    return trie.merge(base)
+
+
+def _scan(expression, start, stops, unescape):
+    """scan until an unescaped char in stops, return (text, stop char, index)"""
+    buf = []
+    i, n = start, len(expression)
+    while i < n:
+        c = expression[i]
+        if c == '\\' and i + 1 < n:
+            if not unescape:
+                buf.append(c)
+            buf.append(expression[i + 1])
+            i += 2
+            continue
+        if c in stops:
+            return ''.join(buf), c, i + 1
+        buf.append(c)
+        i += 1
+    return ''.join(buf), '', n
+
+
+def _parse_set(expression, kind):
+    """parse expression into ((path, value), ...)"""
+    typed = kind == 'set'
+    assignments = []
+    i, n = 0, len(expression)
+    while i < n:
+        # key中的转义由parse_path处理
+        key, stop, i = _scan(expression, i, '=,', unescape=False)
+        if stop != '=':
+            raise CustomError("Invalid set expression {}: key {} has no value".format(
+                expression, key))
+        try:
+            path = parse_path(key)
+        except CustomError as e:
+            raise CustomError("Invalid set expression {}: {}".format(expression, e))
+        if not path:
+            raise CustomError("Invalid set expression {}: empty key {!r}".format(
+                expression, key))
+        if kind != 'file' and expression.startswith('{', i):
+            items = []
+            stop = ','
+            i += 1
+            while stop == ',':
+                item, stop, i = _scan(expression, i, ',}', unescape=True)
+                if stop == '':
+                    raise CustomError("Invalid set expression {}: list is not closed".format(
+                        expression))
+                if item or stop == ',' or items:
+                    items.append(typed_value(item) if typed else item)
+            if i < n and expression[i] != ',':
+                raise CustomError("Invalid set expression {}: unexpected {!r} after }}".format(
+                    expression, expression[i]))
+            i += 1
+            value = tuple(items)
+        else:
+            value, _, i = _scan(expression, i, ',', unescape=True)
+            if typed:
+                value = typed_value(value)
+        assignments.append((path, value))
+    return tuple(assignments)
+
+
+class Setter(object):
+    """
+    Compiled --set expression
+
+        setter = compile_set('image.tag=1.0,replicas=3')
+        values = setter.apply(base_values)
+    """
+    __slots__ = ('expression', 'kind', 'assignments')
+
+    def __init__(self, expression, kind='set'):
+        """
+        Args:
+            expression: --set表达式(str)
+            kind: set(类型转换), string(全部为字符串)或file(值为文件路径,应用时读取文件内容)
+        """
+        if kind not in SET_KINDS:
+            raise CustomError("Unknown set kind {}, choose from {}".format(
+                kind, ", ".join(SET_KINDS)))
+        self.expression = expression
+        self.kind = kind
+        self.assignments = _parse_set(expression, kind)
+
+    def update(self, trie):
+        """将表达式中的覆盖项依次设置到ValuesTrie中"""
+        for path, value in self.assignments:
+            if self.kind == 'file':
+                with open(value) as f:
+                    value = f.read()
+            elif isinstance(value, tuple):
+                # 缓存的Setter会被多次使用,每次生成新的list
+                value = list(value)
+            trie.set(path, value)
+
+    def apply(self, base=None):
+        """
+        Args:
+            base: 基础values(dict),不会被修改
+        Returns:
+            合并后的values(dict)
+        """
+        trie = ValuesTrie()
+        self.update(trie)
+        return trie.merge(base)
+
+    def __repr__(self):
+        return "<Setter --{} {}>".format(
+            'set' if self.kind == 'set' else 'set-' + self.kind, self.expression)
+
+
+@lru_cache(maxsize=1024)
+def compile_set(expression, kind='set'):
+    """return cached Setter of --set expression
+
+    Args:
+        expression: --set表达式(str)
+        kind: set, string或file,分别对应--set, --set-string, --set-file
+
+    Returns:
+        Setter对象
+    """
+    return Setter(expression, kind)
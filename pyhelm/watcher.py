@@ -0,0 +1,214 @@
+# -*- coding:utf-8 -*-
+import logging
+import os
+import sys
+import threading
+from collections import namedtuple
+
+import grpc
+from hapi.release.status_pb2 import Status
+
+""" ReleaseWatcher class 轮询tiller,只通知发生变化的release"""
+
+sys.path.insert(0, os.path.split(
+    os.path.abspath(os.path.dirname(__file__)))[0])
+
+from tiller import LIST_PAGE_SIZE, RELEASE_SUMMARY_FIELDS
+
+LOG = logging.getLogger('pyhelm')
+# 轮询间隔(秒)
+WATCH_INTERVAL = 10
+# 每个release只保留的字段
+WATCH_FIELDS = RELEASE_SUMMARY_FIELDS + ("chart.metadata.version",)
+# SUPERSEDED只会出现在旧版本上,默认不拉取
+WATCH_STATUS_CODES = tuple(code for name, code in Status.Code.items()
+                           if name != 'SUPERSEDED')
+
+ADDED = 'added'
+UPGRADED = 'upgraded'
+DELETED = 'deleted'
+STATUS_CHANGED = 'status_changed'
+EVENT_TYPES = (ADDED, UPGRADED, DELETED, STATUS_CHANGED)
+
+__all__ = ["ReleaseWatcher", "ReleaseEvent", "ADDED", "UPGRADED", "DELETED",
+           "STATUS_CHANGED", "subscribe", "unsubscribe", "fetch", "diff",
+           "poll", "events", "start", "stop"]
+
+
+ReleaseEvent = namedtuple('ReleaseEvent', ['type', 'name', 'release', 'previous'])
+ReleaseEvent.__doc__ = '''release变化事件,type为ADDED/UPGRADED/DELETED/STATUS_CHANGED,
+release为当前的(投影后的)release,purge删除的DELETED事件为None;previous为上一次快照中的release'''
+
+
+class ReleaseWatcher(object):
+    '''
+    ReleaseWatcher class 定时分页拉取release的概要信息,与本地快照比较,
+    只产生发生变化的事件:
+
+        watcher = ReleaseWatcher(Tiller(host), interval=10)
+        watcher.subscribe(lambda event: print(event.type, event.name), DELETED)
+        watcher.start()
+        ...
+        watcher.stop()
+
+    或者直接迭代:
+
+        for event in watcher.events():
+            ...
+    '''
+
+    def __init__(self, tiller, interval=WATCH_INTERVAL, namespace=None,
+                 status_codes=WATCH_STATUS_CODES, filter='', fields=WATCH_FIELDS,
+                 page_size=LIST_PAGE_SIZE, emit_initial=False):
+        """ReleaseWatcher Class 构造函数
+        Args:
+            tiller: Tiller对象
+            interval: 轮询间隔,单位秒(int)
+            namespace: 只关注的k8s namespace(str)
+            status_codes: 拉取的release状态列表
+            filter: release名称正则过滤(str)
+            fields: 每个release只保留的字段,必须包含name, version和info.status.code
+            page_size: 每页release数量(int)
+            emit_initial: 第一次轮询时是否为已有的release产生ADDED事件(bool)
+        Returns:
+            无返回值
+        """
+        self.tiller = tiller
+        self.interval = interval
+        self.namespace = namespace
+        self.status_codes = list(status_codes)
+        self.filter = filter
+        self.fields = fields
+        self.page_size = page_size
+        self.emit_initial = emit_initial
+
+        # {release名称: 最新版本的release}
+        self.snapshot = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def subscribe(self, callback, *event_types):
+        """注册回调函数
+        Args:
+            callback: 参数为ReleaseEvent的函数
+            event_types: 只接收的事件类型,为空时接收所有事件
+        Returns:
+            callback,便于作为装饰器使用
+        """
+        self._callbacks.append((callback, frozenset(event_types or EVENT_TYPES)))
+        return callback
+
+    def unsubscribe(self, callback):
+        """删除回调函数"""
+        self._callbacks = [(cb, types) for cb, types in self._callbacks
+                           if cb is not callback]
+
+    def fetch(self):
+        """拉取当前release,同名release只保留版本最高的一个
+        Returns:
+            {release名称: release}
+        """
+        current = {}
+        for release in self.tiller.iter_releases(
+                page_size=self.page_size, status_codes=self.status_codes,
+                namespace=self.namespace, filter=self.filter,
+                fields=self.fields):
+            latest = current.get(release.name)
+            if latest is None or release.version > latest.version:
+                current[release.name] = release
+        return current
+
+    @staticmethod
+    def diff(previous, current):
+        """比较两次快照
+        Args:
+            previous: 上一次的快照{名称: release}
+            current: 本次的快照{名称: release}
+        Returns:
+            ReleaseEvent列表
+        """
+        events = []
+        for name, release in current.items():
+            old = previous.get(name)
+            if old is None:
+                events.append(ReleaseEvent(ADDED, name, release, None))
+            elif release.version != old.version:
+                events.append(ReleaseEvent(UPGRADED, name, release, old))
+            elif release.info.status.code != old.info.status.code:
+                # 不带--purge的helm delete只把状态改为DELETED,release仍在列表中
+                if release.info.status.code == Status.DELETED:
+                    events.append(ReleaseEvent(DELETED, name, release, old))
+                else:
+                    events.append(ReleaseEvent(STATUS_CHANGED, name, release, old))
+        for name, old in previous.items():
+            # 已经通知过DELETED的release被purge时不再重复通知
+            if name not in current and old.info.status.code != Status.DELETED:
+                events.append(ReleaseEvent(DELETED, name, None, old))
+        return events
+
+    def poll(self):
+        """轮询一次,更新快照并通知回调函数
+        Returns:
+            本次产生的ReleaseEvent列表
+        """
+        current = self.fetch()
+        with self._lock:
+            previous, self.snapshot = self.snapshot, current
+        if previous is None:
+            if not self.emit_initial:
+                return []
+            previous = {}
+        events = self.diff(previous, current)
+        for event in events:
+            for callback, types in list(self._callbacks):
+                if event.type not in types:
+                    continue
+                try:
+                    callback(event)
+                except Exception as e:
+                    LOG.error("Release watcher callback %s failed: %s", callback, e)
+        return events
+
+    def events(self):
+        """按interval轮询并逐个返回事件,直到调用stop
+        Returns:
+            iterator of ReleaseEvent
+        """
+        self._stopped.clear()
+        while not self._stopped.is_set():
+            for event in self.poll():
+                yield event
+            self._stopped.wait(self.interval)
+
+    __iter__ = events
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self.poll()
+            except grpc.RpcError as e:
+                LOG.error("Release watcher poll failed: %s", e)
+            self._stopped.wait(self.interval)
+
+    def start(self):
+        """在后台线程中轮询,事件通过回调函数通知"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="pyhelm-watcher")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """停止轮询,等待后台线程退出"""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+
+if __name__ == "__main__":
+    import watcher
+    print(help(watcher))
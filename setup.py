@@ -12,8 +12,8 @@ setup(
     long_description=open('README.rst').read(),
     install_requires=[
         "gitpython==2.1.9",
-        "grpcio==1.12.1",
-        "grpcio-tools==1.12.1",
+        "grpcio>=1.32.0",
+        "grpcio-tools>=1.32.0",
         "protobuf==3.18.3",
         "PyYAML>=4.2b1",
         "requests==2.19.1",